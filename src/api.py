@@ -1,22 +1,39 @@
-import os
+import datetime
 import time
+import hashlib
 import logging
-import datetime
+from dataclasses import dataclass
+from typing import Union
 
-from flask import Flask, request, send_file
+from flask import Flask, Response, request, send_file
 from flask_cors import CORS
+import orjson
 import pandas
-import numpy as np
 from config import settings, parser
 from databases import redis
-from status_invest import filter_stocks
+from status_invest import filter_stocks, get_missing_indexes, get_stocks_by_index
+from result_cache import ResultCache
+from snapshot import SnapshotStore
+from index_cache import IndexMembershipCache
+import backtest
 import magic_formula
+import ranking
+import exports
 from swagger import swagger_blueprint, swagger_base_bp
 
 
 app = Flask(__name__)
 CORS(app)
 
+result_cache = ResultCache(settings.result_cache_max_entries)
+"""rankings already calculated by this worker, keyed by the request parameters"""
+snapshot_store = SnapshotStore()
+"""stocks information published by the service, kept in memory while the version does not change"""
+index_cache = IndexMembershipCache()
+"""tickers of each index published by the service"""
+backtest_cache = ResultCache(settings.backtest_cache_max_entries)
+"""backtests and panels already calculated by this worker, bound to a window of backtest_cache_seconds"""
+
 
 def get_indexes_args():
     """Bovespa indexes
@@ -45,78 +62,279 @@ def get_indexes_args():
 
 
 def get_list_tickers_args():
-    list_tickers = request.args.getlist('list_tickers', [])
+    list_tickers = request.args.getlist('list_tickers')
     if list_tickers == ['']:
         list_tickers = []
     return list_tickers
 
 
+@dataclass(frozen=True)
+class RankingParameters:
+    """Parameters of the magic formula ranking, normalized so equivalent requests are equal"""
+    indexes: tuple
+    list_tickers: tuple
+    min_ebit: int = 1
+    min_market_cap: int = 0
+    roic_ignore: int = 0
+    graham_max_pl: float = 15
+    graham_max_pvp: float = 1.5
+    number_of_stocks: int = 150
+
+    @classmethod
+    def from_request(cls) -> 'RankingParameters':
+        # the order of the indexes and tickers does not change the result
+        return cls(
+            indexes=tuple(sorted(set(get_indexes_args()))),
+            list_tickers=tuple(sorted(set(get_list_tickers_args()))),
+            min_ebit=int(request.args.get('min_ebit', 1)),
+            min_market_cap=int(request.args.get('min_market_cap', 0)),
+            roic_ignore=int(request.args.get('roic_ignore', 0)),
+            graham_max_pl=float(request.args.get('graham_max_pl', 15)),
+            graham_max_pvp=float(request.args.get('graham_max_pvp', 1.5)),
+            number_of_stocks=int(request.args.get('number_of_stocks', 150)),
+        )
+
+
+async def rank_stocks(
+        stocks_data: dict,
+        parameters: RankingParameters,
+        index_members: dict = None) -> dict:
+    """Runs the magic formula over the stocks information published by the service
+
+    Returns:
+        returns a dict with the columns of the stocks ordered by the magic index
+    """
+    stocks_data = await filter_stocks(stocks_data, list(parameters.indexes), list(parameters.list_tickers),
+                                      parameters.min_ebit, parameters.min_market_cap, app.logger, index_members)
+    if parameters.graham_max_pl != 15 or parameters.graham_max_pvp != 1.5:
+        # the snapshot columns are shared between requests, so the new values go on a copy of the dict
+        stocks_data = dict(stocks_data)
+        stocks_data['graham_vi'] = magic_formula.calculate_graham_vi_array(
+            stocks_data['vpa'], stocks_data['lpa'], parameters.graham_max_pl, parameters.graham_max_pvp
+        )
+        stocks_data['graham_upside'] = magic_formula.calculate_graham_upside_array(
+            stocks_data['current_price'], stocks_data['graham_vi']
+        )
+
+    return ranking.rank_stocks(stocks_data, parameters.number_of_stocks, parameters.roic_ignore)
+
+
+async def get_ranking(
+        conn_info: redis.RedisConnectionInfo,
+        version: bytes,
+        data_version: Union[None, tuple],
+        parameters: RankingParameters,
+        index_members: dict) -> Union[None, dict]:
+    """Returns the ranking for the parameters, from the cache when it was already calculated for the data version
+
+    Args:
+        conn_info (redis.RedisConnectionInfo): connection info
+        version (bytes): version of the stocks information
+        data_version (Union[None, tuple]): version of the stocks information and of the index tickers, see get_data_version
+        parameters (RankingParameters): parameters of the ranking
+        index_members (dict): tickers of each index, the ones used on the index tickers version
+
+    Returns:
+        returns a dict with the columns of the ranking, None if the version is no longer available
+    """
+    tickers = result_cache.get(data_version, parameters)
+    if tickers is not None:
+        app.logger.info(f'Ranking found on cache for version {data_version}')
+        return tickers
+
+    stocks_data = await snapshot_store.get_data(conn_info, version)
+    if stocks_data is None:
+        return None
+    tickers = await rank_stocks(stocks_data, parameters, index_members)
+    result_cache.set(data_version, parameters, tickers)
+    return tickers
+
+
+def get_data_version(
+        version: Union[None, bytes], index_version: Union[None, str], parameters: RankingParameters) -> Union[None, tuple]:
+    """Version of everything used by the ranking, the index tickers only count when the ranking is filtered by them
+
+    Returns:
+        returns a tuple with both versions, None if the stocks information has no version
+    """
+    if version is None:
+        return None
+    uses_indexes = parameters.indexes != ('NONE', ) and not parameters.list_tickers
+    return version, index_version if uses_indexes else None
+
+
+def get_etag(data_version: tuple, parameters: RankingParameters, file_format: str) -> str:
+    """Creates the etag of the response, it only changes when the service publishes a new version or new index tickers"""
+    return hashlib.sha1(f'{data_version!r}|{parameters!r}|{file_format}'.encode()).hexdigest()
+
+
+def add_cache_headers(response: Response, etag: str) -> Response:
+    if etag:
+        response.set_etag(etag)
+        # send_file marks the exports as no-cache, the etag makes them cacheable like the json responses
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = settings.api_cache_max_age_seconds
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def get_indexes_not_available(indexes: list) -> tuple:
+    # the service did not publish the tickers of the indexes yet, answering without them would drop every ticker
+    return {'error': f'tickers of the indexes {", ".join(indexes)} are not available yet'}, 503
+
+
+def get_version_not_found(version: bytes) -> tuple:
+    return {'error': f'version {version.decode()} is no longer available'}, 404
+
+
+def get_as_of_arg():
+    """Reads the as_of parameter as nanoseconds since the epoch, the unit of the published versions
+
+    An integer is used as a version, a date includes the whole day and a datetime
+    without a timezone is considered to be in UTC.
+    """
+    value = request.args.get('as_of')
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+
+    try:
+        end_of_day = datetime.datetime.combine(datetime.date.fromisoformat(value), datetime.time.max)
+        as_of = end_of_day.replace(tzinfo=datetime.timezone.utc)
+    except ValueError:
+        as_of = datetime.datetime.fromisoformat(value)
+        if as_of.tzinfo is None:
+            as_of = as_of.replace(tzinfo=datetime.timezone.utc)
+    return int(as_of.timestamp()) * 1_000_000_000 + as_of.microsecond * 1_000
+
+
 @app.route('/api/magic_formula', methods=['GET'])
 async def get_stocks_info():
     start = time.perf_counter()
-    roic_ignore = int(request.args.get('roic_ignore', 0))
-    indexes = get_indexes_args()
     file_format = request.args.get('format', 'json').lower()
-    min_ebit = int(request.args.get('min_ebit', 1))
-    min_market_cap = int(request.args.get('min_market_cap', 0))
-    number_of_stocks = int(request.args.get('number_of_stocks', 150))
-    graham_max_pl = float(request.args.get('graham_max_pl', 15))
-    graham_max_pvp = float(request.args.get('graham_max_pvp', 1.5))
-    list_tickers = get_list_tickers_args()
-
-    identifier = 'magic_formula_main_data'
+    parameters = RankingParameters.from_request()
+    try:
+        as_of = get_as_of_arg()
+    except ValueError:
+        return {'error': 'as_of must be a version or an ISO 8601 date'}, 400
+
     conn_info = redis.RedisConnectionInfo(
         settings.credentials['redis']['hostname'],
         settings.credentials['redis'].getint('port'),
         settings.credentials['redis']['password'],
     )
+    if as_of is None:
+        version = await snapshot_store.get_version(conn_info)
+    else:
+        # past versions do not have the live tickers, the ones of the run are only on the current information
+        version = await snapshot_store.get_version_as_of(conn_info, as_of)
+        if version is None:
+            return {'error': f'no version published until {request.args.get("as_of")}'}, 404
+
+    index_members, index_version = await index_cache.get_versioned(conn_info)
+    missing_indexes = get_missing_indexes(list(parameters.indexes), list(parameters.list_tickers), index_members)
+    if missing_indexes:
+        return get_indexes_not_available(missing_indexes)
+
+    # without a version there is no way to know when the data changes, so the response is not cacheable
+    data_version = get_data_version(version, index_version, parameters)
+    etag = get_etag(data_version, parameters, file_format) if data_version is not None else None
+    if etag and request.if_none_match.contains(etag):
+        app.logger.info(f'Not modified, finished in {time.perf_counter() - start} seconds')
+        return add_cache_headers(Response(status=304), etag)
+
+    if file_format in exports.EXPORT_FORMATS:
+        tickers = await get_ranking(conn_info, version, data_version, parameters, index_members)
+        if tickers is None:
+            return get_version_not_found(version)
+        _, mimetype = exports.EXPORT_FORMATS[file_format]
+        output = exports.export_dataframe(pandas.DataFrame(tickers), file_format)
+        response = send_file(output, mimetype=mimetype, as_attachment=True,
+                             download_name=exports.get_filename(file_format))
+        return add_cache_headers(response, etag)
+
+    # the encoded body is cached apart from the ranking, so repeated requests skip the serialization
+    json_key = ('json', parameters)
+    body = result_cache.get(data_version, json_key)
+    if body is None:
+        tickers = await get_ranking(conn_info, version, data_version, parameters, index_members)
+        if tickers is None:
+            return get_version_not_found(version)
+        body = exports.records_to_json(tickers)
+        result_cache.set(data_version, json_key, body)
 
-    stocks_data = await redis.get_object_from_redis_async(conn_info, identifier)
-    stocks_data = await filter_stocks(stocks_data, indexes, list_tickers,
-                                      min_ebit, min_market_cap, app.logger)
-    if graham_max_pl != 15 or graham_max_pvp != 1.5:
-        for stock in stocks_data:
-            stock['graham_vi'] = await magic_formula.calculate_graham_vi(
-                stock['vpa'], stock['lpa'], graham_max_pl, graham_max_pvp
-            )
-            stock['graham_upside'] = await magic_formula.calculate_graham_upside(
-                stock['current_price'], stock['graham_vi']
-            )
-
-    tickers_df = pandas.DataFrame(
-        columns=['symbol', 'roic', 'vpa', 'lpa', 'p_l', 'p_vp', 'dividend_yield',
-                 'current_price', 'earning_yield', 'graham_vi', 'graham_upside',
-                 'ebit', 'market_cap'],
-        data=stocks_data
+    app.logger.info(f'Finished in {time.perf_counter() - start} seconds')
+    return add_cache_headers(Response(body, mimetype='application/json'), etag)
+
+
+def get_date_arg(name: str):
+    value = request.args.get(name)
+    return datetime.date.fromisoformat(value) if value else None
+
+
+def get_backtest_parameters() -> backtest.BacktestParameters:
+    source = request.args.get('source', 'snapshots').lower()
+    if source not in backtest.SOURCES:
+        raise ValueError(f'source must be one of {", ".join(backtest.SOURCES)}')
+
+    return backtest.BacktestParameters(
+        indexes=tuple(sorted(set(get_indexes_args()))),
+        list_tickers=tuple(sorted(set(get_list_tickers_args()))),
+        number_of_stocks=int(request.args.get('number_of_stocks', 30)),
+        roic_ignore=int(request.args.get('roic_ignore', 0)),
+        min_ebit=int(request.args.get('min_ebit', 1)),
+        min_market_cap=int(request.args.get('min_market_cap', 0)),
+        rebalance_every=int(request.args.get('rebalance_every', 21)),
+        source=source,
+        start=get_date_arg('start'),
+        end=get_date_arg('end'),
     )
-    tickers_df.sort_values('roic', ascending=False)
-    tickers_df['roic_index_number'] = np.arange(tickers_df['roic'].count())
-    if roic_ignore:
-        tickers_df['roic_index_number'] = [0] * tickers_df['roic'].count()
-
-    tickers_df = tickers_df.sort_values('earning_yield', ascending=False)
-
-    tickers_df['earning_yield_index'] = np.arange(tickers_df['earning_yield'].count())
-    tickers_df['magic_index'] = tickers_df['earning_yield_index'] + tickers_df['roic_index_number']
-    tickers_df = tickers_df.sort_values('magic_index', ascending=True)
-
-    if number_of_stocks:
-        tickers_df = tickers_df.head(number_of_stocks)
-
-    if file_format == 'excel':
-        filename = f'magic_formula_{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}.xlsx'
-        tickers_df.to_excel(
-            filename,
-            sheet_name='stocks', index=False, engine='openpyxl',
-            freeze_panes=(1, 0)
+
+
+@app.route('/api/magic_formula/backtest', methods=['GET'])
+async def get_backtest():
+    start = time.perf_counter()
+    try:
+        parameters = get_backtest_parameters()
+    except ValueError as error:
+        return {'error': str(error)}, 400
+
+    # the stored information changes at most once per run of the service, so the results are kept for a while
+    cache_version = int(time.time() // settings.backtest_cache_seconds)
+    body = backtest_cache.get(cache_version, parameters)
+    if body is None:
+        panel_key = ('panel', parameters.source, parameters.start, parameters.end)
+        panel = backtest_cache.get(cache_version, panel_key)
+        if panel is None:
+            panel = await backtest.load_panel(parameters.source, parameters.start, parameters.end)
+            if panel is None:
+                return settings.NOT_FOUND_DB_RESPONSE
+            backtest_cache.set(cache_version, panel_key, panel)
+
+        conn_info = redis.RedisConnectionInfo(
+            settings.credentials['redis']['hostname'],
+            settings.credentials['redis'].getint('port'),
+            settings.credentials['redis']['password'],
         )
-        file = send_file(filename)
-        os.remove(filename)
-        return file
+        index_tickers = None
+        if list(parameters.indexes) != ['NONE'] or parameters.list_tickers:
+            index_members = await index_cache.get(conn_info)
+            missing_indexes = get_missing_indexes(list(parameters.indexes), list(parameters.list_tickers), index_members)
+            if missing_indexes:
+                return get_indexes_not_available(missing_indexes)
+            index_tickers = await get_stocks_by_index(list(parameters.indexes), list(parameters.list_tickers),
+                                                      app.logger, index_members)
 
-    app.logger.info(f'Finished in {time.perf_counter() - start} seconds')
-    tickers = tickers_df.to_dict(orient='records')
-    return tickers
+        body = orjson.dumps(backtest.run_backtest(panel, parameters, index_tickers))
+        backtest_cache.set(cache_version, parameters, body)
+
+    app.logger.info(f'Backtest finished in {time.perf_counter() - start} seconds')
+    response = Response(body, mimetype='application/json')
+    response.cache_control.max_age = settings.api_cache_max_age_seconds
+    return response
 
 
 def main():
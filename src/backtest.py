@@ -0,0 +1,326 @@
+"""Module with the backtest of the magic formula over the stored snapshots or the stored history
+
+The information is organized as panels, 2d arrays with a row for each date and a
+column for each ticker, so the ranking of every date is done at once by the ranking
+engine instead of one date at a time.
+"""
+import datetime
+import math
+from dataclasses import dataclass
+from typing import Union
+
+import numpy as np
+
+from config import settings
+from databases import postgres
+import history
+import ranking
+import snapshot
+
+
+PANEL_FIELDS = ('roic', 'earning_yield', 'ebit', 'market_cap', 'price')
+"""fields of the panel used by the backtest"""
+
+SOURCES = ('snapshots', 'history')
+
+
+@dataclass
+class Panel:
+    """Information of the tickers on each date, each field is an array of shape (dates, tickers)"""
+    dates: np.ndarray
+    symbols: np.ndarray
+    fields: dict
+
+
+@dataclass(frozen=True)
+class BacktestParameters:
+    """Parameters of the backtest, normalized so equivalent requests are equal"""
+    indexes: tuple
+    list_tickers: tuple
+    number_of_stocks: int = 30
+    roic_ignore: int = 0
+    min_ebit: int = 1
+    min_market_cap: int = 0
+    rebalance_every: int = 21
+    source: str = 'snapshots'
+    start: Union[None, datetime.date] = None
+    end: Union[None, datetime.date] = None
+
+
+def build_panel(dates: np.ndarray, symbols: np.ndarray, fields: dict) -> Panel:
+    """Creates the panel from rows with a date, a symbol and the fields
+
+    Args:
+        dates (np.ndarray): date of each row
+        symbols (np.ndarray): ticker of each row
+        fields (dict): array with the values of each row for each field of PANEL_FIELDS
+
+    Returns:
+        returns the panel, nan where a ticker has no information on a date
+    """
+    panel_dates, date_index = np.unique(dates, return_inverse=True)
+    panel_symbols, symbol_index = np.unique(symbols, return_inverse=True)
+    panel_fields = {}
+    for name in PANEL_FIELDS:
+        values = np.full((len(panel_dates), len(panel_symbols)), np.nan)
+        values[date_index, symbol_index] = fields[name]
+        panel_fields[name] = values
+    return Panel(panel_dates, panel_symbols, panel_fields)
+
+
+def _rows_to_columns(rows: list, names: tuple, numeric_names: tuple) -> dict:
+    columns = {}
+    for name in names:
+        if name in numeric_names:
+            columns[name] = np.array([np.nan if row[name] is None else row[name] for row in rows], dtype=np.float64)
+        else:
+            columns[name] = np.array([row[name] for row in rows], dtype=object)
+    return columns
+
+
+def _query_failed(rows: list) -> bool:
+    return bool(rows) and 'error' in rows[0]
+
+
+async def load_snapshots_panel(start: datetime.date = None, end: datetime.date = None) -> Union[None, Panel]:
+    """Loads the snapshots stored on postgres by persist_snapshot, keeping the last snapshot of each day
+
+    Args:
+        start (datetime.date): first date, if not informed starts on the first snapshot
+        end (datetime.date): last date, if not informed ends on the last snapshot
+
+    Returns:
+        returns the panel, None if the query failed
+    """
+    query = f'''
+        WITH daily AS (
+            SELECT max(version) AS version, to_timestamp(version / 1e9)::date AS date
+            FROM {snapshot.SNAPSHOT_TABLE}
+            WHERE (%(start)s::date IS NULL OR to_timestamp(version / 1e9)::date >= %(start)s)
+              AND (%(end)s::date IS NULL OR to_timestamp(version / 1e9)::date <= %(end)s)
+            GROUP BY to_timestamp(version / 1e9)::date
+        )
+        SELECT daily.date, s.symbol, s.roic, s.earning_yield, s.ebit, s.market_cap, s.current_price AS price
+        FROM {snapshot.SNAPSHOT_TABLE} s JOIN daily ON daily.version = s.version
+    '''
+    rows = await postgres.get_info_from_database(query, {'start': start, 'end': end})
+    if _query_failed(rows):
+        return None
+
+    columns = _rows_to_columns(rows, ('date', 'symbol', *PANEL_FIELDS), PANEL_FIELDS)
+    return build_panel(columns['date'].astype('datetime64[D]'), columns['symbol'].astype(str), columns)
+
+
+async def load_history_panel(start: datetime.date = None, end: datetime.date = None) -> Union[None, Panel]:
+    """Loads the history stored on postgres by the history module, with a date for each year
+
+    The indicators of a year are only known after the results are released, so they are
+    used with the first price of the ticker on or after the backtest_history_month of the
+    next year.
+
+    Args:
+        start (datetime.date): first date, if not informed starts on the first year
+        end (datetime.date): last date, if not informed ends on the last year
+
+    Returns:
+        returns the panel, None if the query failed
+    """
+    query = f'''
+        WITH indicators AS (
+            SELECT ticker, year,
+                   max(value) FILTER (WHERE indicator = 'roic') AS roic,
+                   max(value) FILTER (WHERE indicator = 'ev_ebit') AS ev_ebit
+            FROM {history.INDICATOR_HISTORY_TABLE}
+            WHERE indicator IN ('roic', 'ev_ebit')
+            GROUP BY ticker, year
+        ), prices AS (
+            SELECT DISTINCT ON (ticker, EXTRACT(year FROM date))
+                   ticker, EXTRACT(year FROM date)::int - 1 AS year, date, price
+            FROM {history.PRICE_HISTORY_TABLE}
+            WHERE EXTRACT(month FROM date) >= %(month)s
+            ORDER BY ticker, EXTRACT(year FROM date), date
+        )
+        SELECT prices.date, prices.ticker AS symbol, indicators.roic, indicators.ev_ebit, prices.price
+        FROM prices JOIN indicators USING (ticker, year)
+        WHERE (%(start)s::date IS NULL OR prices.date >= %(start)s)
+          AND (%(end)s::date IS NULL OR prices.date <= %(end)s)
+    '''
+    rows = await postgres.get_info_from_database(
+        query, {'start': start, 'end': end, 'month': settings.backtest_history_month}
+    )
+    if _query_failed(rows):
+        return None
+
+    columns = _rows_to_columns(rows, ('date', 'symbol', 'roic', 'ev_ebit', 'price'), ('roic', 'ev_ebit', 'price'))
+    ev_ebit = columns['ev_ebit']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # the earning yield is ebit / ev, the inverse of ev / ebit
+        columns['earning_yield'] = np.where(ev_ebit != 0, 1 / ev_ebit, np.nan)
+    # ebit and market cap are not on the history, the filters do not exclude unknown values
+    columns['ebit'] = np.full(len(rows), np.nan)
+    columns['market_cap'] = np.full(len(rows), np.nan)
+    # the month of the first price changes between the years, so the dates are aligned to the year
+    dates = np.array([date.replace(month=settings.backtest_history_month, day=1) for date in columns['date']],
+                     dtype='datetime64[D]')
+    return build_panel(dates, columns['symbol'].astype(str), columns)
+
+
+async def load_panel(source: str, start: datetime.date = None, end: datetime.date = None) -> Union[None, Panel]:
+    if source == 'history':
+        return await load_history_panel(start, end)
+    return await load_snapshots_panel(start, end)
+
+
+def get_eligible(panel: Panel, parameters: BacktestParameters, index_tickers: Union[None, set]) -> np.ndarray:
+    """Returns a mask of the tickers that can be selected on each date, following the rules of filter_stocks"""
+    fields = panel.fields
+    eligible = np.isfinite(fields['price']) & (fields['price'] > 0) & np.isfinite(fields['earning_yield'])
+    if not parameters.roic_ignore:
+        eligible &= np.isfinite(fields['roic'])
+
+    if index_tickers is not None:
+        # nan comparisons are false, so unknown values are not excluded
+        eligible &= ~(fields['ebit'] < parameters.min_ebit)
+        eligible &= ~(fields['market_cap'] < parameters.min_market_cap)
+        eligible &= np.isin(panel.symbols, list(index_tickers))[np.newaxis, :]
+    return eligible
+
+
+def select_portfolios(panel: Panel, eligible: np.ndarray, number_of_stocks: int, roic_ignore: int) -> np.ndarray:
+    """Ranks every date at once and selects the best stocks of each date
+
+    Args:
+        panel (Panel): information of the tickers
+        eligible (np.ndarray): mask of the tickers that can be selected on each date
+        number_of_stocks (int): quantity of stocks on each portfolio
+        roic_ignore (int): if informed the roic is not used on the formula
+
+    Returns:
+        returns a boolean array of shape (dates, tickers) with the selected stocks
+    """
+    roic = np.where(eligible, panel.fields['roic'], np.nan)
+    earning_yield = np.where(eligible, panel.fields['earning_yield'], np.nan)
+    _, earning_yield_index, magic_index = ranking.calculate_magic_index(roic, earning_yield, roic_ignore)
+
+    size = eligible.shape[1]
+    # same order of ranking.select_top, with the tickers that can not be selected at the end
+    sort_key = np.where(eligible, magic_index * max(size, 1) + earning_yield_index, np.iinfo(np.int64).max)
+    number_of_stocks = min(max(number_of_stocks, 1), size)
+    best = np.argpartition(sort_key, number_of_stocks - 1, axis=1)[:, :number_of_stocks]
+
+    selected = np.zeros(eligible.shape, dtype=bool)
+    np.put_along_axis(selected, best, True, axis=1)
+    return selected & eligible
+
+
+def max_drawdown(equity: np.ndarray) -> float:
+    if not len(equity):
+        return 0.0
+    return float(np.min(equity / np.maximum.accumulate(equity) - 1))
+
+
+def simulate(panel: Panel, selected: np.ndarray, rebalance_every: int) -> dict:
+    """Simulates equal weight portfolios rebalanced every `rebalance_every` dates
+
+    Between the rebalances the positions are kept, so their weights change with the prices.
+    Missing prices are considered unchanged.
+
+    Args:
+        panel (Panel): information of the tickers
+        selected (np.ndarray): stocks selected on each date, only the rebalance dates are used
+        rebalance_every (int): number of dates between the rebalances
+
+    Returns:
+        returns a dict with the returns of each date, the equity curve and the turnover of each rebalance
+    """
+    dates = len(panel.dates)
+    rebalance_every = max(rebalance_every, 1)
+    block = (np.arange(dates) // rebalance_every) * rebalance_every
+    rebalance_dates = np.arange(0, dates, rebalance_every)
+
+    counts = selected[rebalance_dates].sum(axis=1, keepdims=True)
+    targets = np.zeros(selected.shape)
+    targets[rebalance_dates] = np.divide(selected[rebalance_dates], counts, where=counts > 0,
+                                         out=np.zeros((len(rebalance_dates), selected.shape[1])))
+
+    prices = panel.fields['price']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        asset_returns = prices[1:] / prices[:-1] - 1
+    asset_returns = np.nan_to_num(asset_returns, nan=0.0, posinf=0.0, neginf=0.0)
+    # growth of each ticker since the first date, used to find the growth since any rebalance
+    growth = np.vstack([np.ones((1, prices.shape[1])), np.cumprod(1 + asset_returns, axis=0)])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative = np.nan_to_num(growth / growth[block], nan=0.0, posinf=0.0)
+        # value of each position on each date, for the portfolio of its rebalance
+        values = targets[block] * relative
+        next_values = targets[block[:-1]] * np.nan_to_num(growth[1:] / growth[block[:-1]], nan=0.0, posinf=0.0)
+        period_returns = np.nan_to_num(next_values.sum(axis=1) / values[:-1].sum(axis=1) - 1, nan=0.0)
+
+        # weights before each rebalance, after the changes of the prices since the previous one
+        previous = rebalance_dates[1:]
+        drifted = targets[block[previous - 1]] * np.nan_to_num(growth[previous] / growth[block[previous - 1]], nan=0.0)
+        drifted = np.nan_to_num(drifted / drifted.sum(axis=1, keepdims=True), nan=0.0)
+    turnover = np.concatenate([[1.0 if len(rebalance_dates) and counts[0, 0] else 0.0],
+                               0.5 * np.abs(targets[previous] - drifted).sum(axis=1)])
+
+    return {
+        'returns': period_returns,
+        'equity': np.concatenate([[1.0], np.cumprod(1 + period_returns)]),
+        'turnover': turnover,
+        'rebalance_dates': rebalance_dates,
+    }
+
+
+def summarize(panel: Panel, selected: np.ndarray, simulation: dict) -> dict:
+    """Calculates the metrics of the backtest, returning only values that can be serialized to json"""
+    equity = simulation['equity']
+    returns = simulation['returns']
+    dates = panel.dates
+    years = (dates[-1] - dates[0]).astype(int) / 365.25 if len(dates) > 1 else 0
+    total_return = float(equity[-1] - 1) if len(dates) else 0.0
+    annualized = float((1 + total_return) ** (1 / years) - 1) if years > 0 and total_return > -1 else None
+    periods_per_year = (len(dates) - 1) / years if years > 0 else 0
+    volatility = float(np.std(returns) * math.sqrt(periods_per_year)) if len(returns) > 1 and periods_per_year else None
+
+    rebalances = simulation['rebalance_dates']
+    return {
+        'start': str(dates[0]) if len(dates) else None,
+        'end': str(dates[-1]) if len(dates) else None,
+        'periods': int(len(dates)),
+        'total_return': total_return,
+        'annualized_return': annualized,
+        'annualized_volatility': volatility,
+        'max_drawdown': max_drawdown(equity),
+        'average_turnover': float(np.mean(simulation['turnover'])) if len(rebalances) else 0.0,
+        'equity': [{'date': str(date), 'value': float(value)} for date, value in zip(dates, equity)],
+        'rebalances': [
+            {
+                'date': str(dates[index]),
+                'turnover': float(turnover),
+                'tickers': panel.symbols[selected[index]].tolist(),
+            }
+            for index, turnover in zip(rebalances, simulation['turnover'])
+        ],
+    }
+
+
+def run_backtest(panel: Panel, parameters: BacktestParameters, index_tickers: Union[None, set] = None) -> dict:
+    """Runs the magic formula on every date of the panel and simulates the portfolios
+
+    Args:
+        panel (Panel): information of the tickers
+        parameters (BacktestParameters): parameters of the backtest
+        index_tickers (Union[None, set]): tickers of the indexes, None to use every ticker without the filters
+
+    Returns:
+        returns a dict with the metrics of the backtest, the equity curve and the portfolio of each rebalance
+    """
+    if not len(panel.dates):
+        return summarize(panel, np.zeros((0, len(panel.symbols)), dtype=bool), {
+            'returns': np.empty(0), 'equity': np.empty(0), 'turnover': np.empty(0), 'rebalance_dates': np.empty(0, dtype=int),
+        })
+
+    eligible = get_eligible(panel, parameters, index_tickers)
+    selected = select_portfolios(panel, eligible, parameters.number_of_stocks, parameters.roic_ignore)
+    return summarize(panel, selected, simulate(panel, selected, parameters.rebalance_every))
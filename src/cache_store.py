@@ -0,0 +1,104 @@
+"""Module with the local cache store used by the scraper, backed by a sqlite database"""
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Iterable, Union
+
+
+class CacheStore:
+    """Key value store with expiration and a maximum size, evicting the least recently used keys
+
+    The values are compressed and kept on a single sqlite file, so a lookup is an
+    indexed query instead of one file per key.
+    """
+
+    def __init__(self, path: str, max_size_bytes: int, default_ttl_seconds: float) -> None:
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.default_ttl_seconds = default_ttl_seconds
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            ' key TEXT PRIMARY KEY,'
+            ' value BLOB NOT NULL,'
+            ' size INTEGER NOT NULL,'
+            ' expires_at REAL NOT NULL,'
+            ' accessed_at REAL NOT NULL)'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)')
+        self._size = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+
+    def get(self, key: str) -> Union[None, bytes]:
+        """Returns the value of the key, None if it does not exists or is expired"""
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: Iterable) -> dict:
+        """Returns the values of the keys found and not expired, using a single query
+
+        Args:
+            keys (Iterable): keys to be retrieved
+
+        Returns:
+            returns a dict with the values of the keys found
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+
+        now = time.time()
+        placeholders = ','.join('?' * len(keys))
+        with self._lock:
+            rows = self._connection.execute(
+                f'SELECT key, value FROM cache WHERE key IN ({placeholders}) AND expires_at > ?',
+                [*keys, now]
+            ).fetchall()
+            if rows:
+                self._connection.execute(
+                    f'UPDATE cache SET accessed_at = ? WHERE key IN ({",".join("?" * len(rows))})',
+                    [now, *[key for key, _ in rows]]
+                )
+        return {key: zlib.decompress(value) for key, value in rows}
+
+    def set(self, key: str, value: bytes, ttl_seconds: float = None):
+        """Stores the value, evicting the least recently used keys if the store gets bigger than max_size_bytes
+
+        Args:
+            key (str): key of the value
+            value (bytes): value to be stored
+            ttl_seconds (float): time for the value to expire, if not informed uses default_ttl_seconds
+        """
+        now = time.time()
+        ttl_seconds = self.default_ttl_seconds if ttl_seconds is None else ttl_seconds
+        compressed = zlib.compress(value)
+        with self._lock:
+            self._connection.execute('BEGIN')
+            previous = self._connection.execute('SELECT size FROM cache WHERE key = ?', [key]).fetchone()
+            self._connection.execute(
+                'INSERT OR REPLACE INTO cache (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                [key, compressed, len(compressed), now + ttl_seconds, now]
+            )
+            self._connection.execute('COMMIT')
+            self._size += len(compressed) - (previous[0] if previous else 0)
+            if self._size > self.max_size_bytes:
+                self._evict(now)
+
+    def _evict(self, now: float):
+        self._connection.execute('BEGIN')
+        self._connection.execute('DELETE FROM cache WHERE expires_at <= ?', [now])
+        self._size = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        # removes the least recently used keys until the store is below 90% of the maximum size
+        target = self.max_size_bytes * 0.9
+        rows = self._connection.execute('SELECT key, size FROM cache ORDER BY accessed_at').fetchall()
+        evicted = []
+        for key, size in rows:
+            if self._size <= target:
+                break
+            evicted.append(key)
+            self._size -= size
+        self._connection.executemany('DELETE FROM cache WHERE key = ?', [[key] for key in evicted])
+        self._connection.execute('COMMIT')
@@ -4,9 +4,190 @@ import threading
 
 file_ttl_minutes = 50
 time_to_sleep_minutes = 60
-parallel_number_requests = 3
+parallel_number_requests = 4
 use_cache = False
 
+cache_path = 'cache/cache.sqlite3'
+"""sqlite file used to cache the status invest responses when use_cache is enabled"""
+
+cache_max_size_mb = 512
+"""maximum size of the cache, the least recently used responses are evicted above it"""
+
+request_interval_seconds = 0
+"""minimum interval between the start of two ticker requests, the requests are also limited by the rate limiter"""
+
+rate_limit_requests_per_second = 5
+"""initial rate of requests to status invest, adapted by the answers of the server"""
+
+rate_limit_min_requests_per_second = 0.5
+rate_limit_max_requests_per_second = 30
+rate_limit_burst = 5
+
+rate_limit_target_latency_seconds = 2
+"""responses slower than this reduce the rate of requests"""
+
+http_max_retries = 4
+"""retries of the requests that fail or are throttled by status invest"""
+
+http_backoff_base_seconds = 0.5
+http_backoff_max_seconds = 30
+
+incremental_scrape = True
+"""only fetches again the pages of the tickers that changed on the search or are older than ticker_page_max_age_minutes"""
+
+ticker_page_max_age_minutes = 6 * 60
+"""maximum age of the page information of a ticker before it is fetched again"""
+
+fingerprint_ignored_fields = []
+"""fields of the search result not considered when checking if a ticker changed, e.g. price"""
+
+http_cache_max_entries = 1000
+"""maximum number of pages kept to be revalidated with conditional requests"""
+
+parser_workers = None
+"""number of processes used to parse the ticker pages, if None uses the number of cpus"""
+
+http_max_connections = 20
+"""maximum number of simultaneous connections of the status invest client"""
+
+http_max_keepalive_connections = 10
+"""connections kept open between the requests to status invest"""
+
+http_keepalive_expiry_seconds = 30
+"""time an idle connection to status invest is kept open"""
+
+http_timeout_seconds = 30
+"""timeout of the requests to status invest"""
+
+http2_enabled = True
+"""uses http/2 on the requests to status invest, multiplexing the requests on fewer connections"""
+
+search_page_size = 200
+"""number of stocks requested on each page of the status invest search"""
+
+search_parallel_pages = 4
+"""maximum number of pages of the status invest search requested at the same time"""
+
+stocks_search_filters = {}
+"""filters of the status invest search, see status_invest.create_search"""
+
+postgres_credentials_section = 'postgres'
+"""section of the credentials file with the postgres connection"""
+
+postgres_pool_min_size = 1
+"""connections kept open on the postgres pool of each process"""
+
+postgres_pool_max_size = 10
+"""maximum number of connections on the postgres pool of each process"""
+
+postgres_pool_max_lifetime_seconds = 30 * 60
+"""connections older than this are closed and replaced by the pool"""
+
+postgres_pool_max_idle_seconds = 5 * 60
+"""connections idle for longer than this are closed when the pool has more than the minimum"""
+
+postgres_pool_timeout_seconds = 10
+"""time to wait for a free connection when the postgres pool is exhausted"""
+
+persist_snapshot_postgres = False
+"""keeps every snapshot published by the service on postgres, see snapshot.persist_snapshot"""
+
+history_enabled = False
+"""loads the historical indicators and prices of the tickers into postgres on the background"""
+
+history_refresh_hours = 24
+"""interval between the loads of the history"""
+
+history_copy_batch_rows = 50000
+"""number of rows collected before they are copied into postgres"""
+
+backtest_history_month = 5
+"""month of the year after the results when the yearly history is used on the backtest, after the results are released"""
+
+backtest_cache_seconds = 10 * 60
+"""time the backtests and the information loaded for them are kept in memory by each api worker"""
+
+backtest_cache_max_entries = 64
+"""maximum number of backtests kept in memory by each api worker"""
+
+service_mode = 'standalone'
+"""default mode of the service: standalone, coordinator or worker, can be changed with --mode"""
+
+distributed_jobs_identifier = 'magic_formula_jobs'
+"""redis list with the tickers waiting to be processed by the workers"""
+
+distributed_processing_identifier = 'magic_formula_jobs_processing'
+"""redis list with the tickers being processed by the workers"""
+
+distributed_lease_prefix = 'magic_formula_job_lease'
+distributed_results_prefix = 'magic_formula_job_results'
+
+distributed_lease_seconds = 120
+"""time without renewal for a job to be considered lost and put back on the queue"""
+
+distributed_poll_seconds = 2
+"""interval of the coordinator checks and maximum time a worker blocks waiting for a job"""
+
+distributed_run_timeout_minutes = 30
+"""maximum time the coordinator waits for the workers, the tickers not processed keep the previous information"""
+
+main_data_identifier = 'magic_formula_main_data'
+"""prefix of the redis keys where the service publishes the stocks information, one key per version (<prefix>:<version>)"""
+
+main_data_version_identifier = 'magic_formula_main_data_version'
+"""redis key pointing to the current version of the stocks information, swapped on every publication"""
+
+main_data_versions_identifier = 'magic_formula_main_data_versions'
+"""redis sorted set with the versions of the stocks information still available"""
+
+main_data_keep_versions = 24
+"""number of versions of the stocks information kept on redis, older versions are removed on the publication"""
+
+api_snapshot_versions_in_memory = 4
+"""number of decoded versions of the stocks information kept in memory by each api worker"""
+
+live_tickers_identifier = 'magic_formula_tickers'
+"""redis hash where the service writes the information of each ticker as soon as it is processed"""
+
+live_tickers_version_identifier = 'magic_formula_tickers_version'
+"""redis key incremented every time the service writes on the live tickers hash"""
+
+live_publish_batch_size = 20
+"""number of tickers written together on the live tickers hash"""
+
+live_publish_interval_seconds = 5
+"""maximum time a processed ticker waits to be written on the live tickers hash, checked by a timer task"""
+
+api_use_live_ticker_data = True
+"""the api uses the information of the tickers already processed by a run that did not finish yet"""
+
+result_cache_max_entries = 256
+"""maximum number of ranking results kept in memory by each api worker"""
+
+redis_max_connections = 20
+"""maximum number of connections on the redis pool of each process"""
+
+redis_pool_timeout_seconds = 5
+"""time to wait for a free connection when the redis pool is exhausted"""
+
+redis_health_check_seconds = 30
+"""interval of the health checks done on the background for the redis pool"""
+
+api_cache_max_age_seconds = 60
+"""max-age sent on the cache-control of the api responses, after that clients revalidate using the etag"""
+
+indexes_identifier = 'magic_formula_indexes'
+"""redis key with the tickers of each index, refreshed by the service"""
+
+indexes_refresh_minutes = 60
+"""interval between the refreshes of the indexes tickers done by the service"""
+
+indexes_ttl_minutes = 24 * 60
+"""time that the indexes tickers stay on redis if the service stops refreshing them"""
+
+api_indexes_refresh_seconds = 60
+"""interval for the api workers to reload the indexes tickers from redis"""
+
 request_uniques = threading.local()
 """variable to handle information that should not be shared between threads"""
 
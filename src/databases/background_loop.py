@@ -0,0 +1,57 @@
+"""Module with an event loop running on a background thread, used by the clients that live for the whole process
+
+Async clients like the redis connection pool are bound to the event loop where their
+connections were created. Flask runs each async view on a new event loop, so the
+clients shared between requests run on this loop and the callers only wait for them.
+"""
+import asyncio
+import functools
+import os
+import threading
+from typing import Any, Coroutine
+
+
+_loop = None
+_loop_pid = None
+_lock = threading.Lock()
+
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    """Returns the background loop of the process, starting it if needed
+
+    Returns:
+        returns the event loop running on the background thread
+    """
+    global _loop, _loop_pid
+    with _lock:
+        # a forked process (gunicorn workers) does not inherit the thread, so a new loop is needed
+        if _loop is None or _loop_pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            thread = threading.Thread(target=_loop.run_forever, name='background_loop', daemon=True)
+            thread.start()
+    return _loop
+
+
+async def run_on_background_loop(coroutine: Coroutine) -> Any:
+    """Runs the coroutine on the background loop and waits for the result on the current loop
+
+    Args:
+        coroutine (Coroutine): coroutine to be executed
+
+    Returns:
+        returns the result of the coroutine
+    """
+    loop = get_background_loop()
+    if asyncio.get_running_loop() is loop:
+        return await coroutine
+
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, loop))
+
+
+def on_background_loop(func):
+    """Decorator to make an async function always execute on the background loop"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_on_background_loop(func(*args, **kwargs))
+    return wrapper
@@ -1,17 +1,20 @@
 """Module to handle connections with postgres"""
+import asyncio
 import logging
 import traceback
 import time
-from typing import Union, Any
+from typing import Union, Any, Iterable, Sequence
 
 import psycopg
-# import psycopg_pool
+import psycopg_pool
+from psycopg import sql
 from psycopg.abc import Query
 from psycopg.rows import dict_row
 # from urllib3.connection import connection
 
 from config import logger
 from config import parser, settings
+from databases.background_loop import on_background_loop
 
 
 async def create_connection_async(db_name: str, db_host: str, db_username: str,
@@ -93,57 +96,226 @@ async def write_query_async_with_connection(connection: psycopg.AsyncConnection,
     return res
 
 
-async def main_aync():
-    credentials = parser.read_ini_file(settings.credentials_file_path)
-    if not credentials:
-        return
-
-    connection = await create_connection_async(
-        db_name=credentials['local_postgres']['database'],
-        db_host=credentials['local_postgres']['hostname'],
-        db_username=credentials['local_postgres']['user'],
-        db_password=credentials['local_postgres']['password'],
-        db_port=credentials['local_postgres'].getint('port'),
+async def write_many_async_with_connection(
+        connection: psycopg.AsyncConnection, query: Query, params_seq: Iterable[Any]) -> dict:
+    """Writes a batch of rows on the database using a async connection, on a single transaction
+
+    The statements are sent with executemany on pipeline mode, so the batch takes a few
+    round trips instead of one for each row.
+
+    Args:
+        connection (psycopg.AsyncConnection): Async connection to postgres
+        query (Query): query to be used
+        params_seq(Iterable[Any]): params of each execution of the query
+
+    Returns:
+        returns a dictionary with the status of the operation and the number of rows affected
+
+    """
+    res = {}
+    logger.log_message(f"Start of batch request to postgresql", level=logging.INFO)
+    request_start_time = time.time()
+    try:
+        async with connection.transaction():
+            async with connection.cursor() as cur:
+                # executemany uses pipeline mode when libpq supports it, sending every row before reading the results
+                await cur.executemany(query, params_seq)
+                rows = cur.rowcount
+        res = {'error': 0, 'desc': 'success', 'rows': rows}
+    except Exception as error:
+        logger.log_message(f'Error to write batch on postgresql: {traceback.format_exc()}', level=logging.ERROR)
+        res = {'error': 1, 'desc': f'failed: {error}', 'rows': 0}
+
+    request_time = round(time.time() - request_start_time, 2)
+    logger.log_message(
+        f"End of batch request to postgresql | RESPONSE TIME: {request_time} seconds, {res['rows']} rows affected",
+        level=logging.INFO
     )
-    res = []
+    return res
+
+
+async def copy_rows_async_with_connection(
+        connection: psycopg.AsyncConnection,
+        table: str,
+        columns: Sequence[str],
+        rows: Iterable[Sequence],
+        conflict_columns: Sequence[str] = (),
+        update_columns: Sequence[str] = ()) -> dict:
+    """Bulk loads the rows with COPY, inserting the new rows and updating the existing ones
+
+    The rows are copied into a temporary table with the same columns and moved to the
+    table with INSERT ... ON CONFLICT, everything on a single transaction. Without
+    update_columns the existing rows are kept as they are (DO NOTHING), otherwise
+    the update_columns are replaced when any of them changed (DO UPDATE).
+
+    Args:
+        connection (psycopg.AsyncConnection): Async connection to postgres
+        table (str): name of the table, it must have a primary key or unique constraint
+        columns (Sequence[str]): columns of the rows, in the same order
+        rows (Iterable[Sequence]): rows to be loaded
+        conflict_columns (Sequence[str]): columns of the primary key or unique constraint, required with update_columns
+        update_columns (Sequence[str]): columns replaced on the rows that already exist
+
+    Returns:
+        returns a dictionary with the status of the operation and the number of rows inserted or updated
+
+    """
+    res = {}
+    logger.log_message(f"Start of copy into {table}", level=logging.INFO)
+    request_start_time = time.time()
+    staging_table = sql.Identifier(f'{table}_staging')
+    column_names = sql.SQL(', ').join(sql.Identifier(column) for column in columns)
+    select = sql.SQL('SELECT {} FROM {}').format(column_names, staging_table)
+    on_conflict = sql.SQL('DO NOTHING')
+    if update_columns:
+        conflict_names = sql.SQL(', ').join(sql.Identifier(column) for column in conflict_columns)
+        # a row can only be updated once by the statement, so repeated keys keep the last row copied
+        select = sql.SQL('SELECT DISTINCT ON ({}) {} FROM {} ORDER BY {}, ctid DESC').format(
+            conflict_names, column_names, staging_table, conflict_names
+        )
+        on_conflict = sql.SQL('({}) DO UPDATE SET {} WHERE ({}) IS DISTINCT FROM ({})').format(
+            conflict_names,
+            sql.SQL(', ').join(
+                sql.SQL('{} = EXCLUDED.{}').format(sql.Identifier(column), sql.Identifier(column))
+                for column in update_columns
+            ),
+            sql.SQL(', ').join(sql.Identifier(table, column) for column in update_columns),
+            sql.SQL(', ').join(sql.SQL('EXCLUDED.{}').format(sql.Identifier(column)) for column in update_columns),
+        )
+    copied = 0
     try:
-        res = await read_query_async_with_connection(connection, 'select 1 as teste')
-    except Exception:
-        if connection and not connection.closed:
-            await connection.close()
+        async with connection.transaction():
+            async with connection.cursor() as cur:
+                await cur.execute(sql.SQL(
+                    'CREATE TEMPORARY TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP'
+                ).format(staging_table, sql.Identifier(table)))
+                async with cur.copy(sql.SQL('COPY {} ({}) FROM STDIN').format(staging_table, column_names)) as copy:
+                    for row in rows:
+                        await copy.write_row(row)
+                        copied += 1
+                await cur.execute(sql.SQL('INSERT INTO {} ({}) {} ON CONFLICT {}').format(
+                    sql.Identifier(table), column_names, select, on_conflict
+                ))
+                res = {'error': 0, 'desc': 'success', 'rows': cur.rowcount}
+    except Exception as error:
+        logger.log_message(f'Error to copy info into postgresql: {traceback.format_exc()}', level=logging.ERROR)
+        res = {'error': 1, 'desc': f'failed: {error}', 'rows': 0}
 
+    request_time = round(time.time() - request_start_time, 2)
+    logger.log_message(
+        f"End of copy into {table} | RESPONSE TIME: {request_time} seconds, {copied} rows copied, {res['rows']} written",
+        level=logging.INFO
+    )
     return res
 
 
-async def get_info_from_database(base_query: Query, params: Any = None) -> list:
-    """Gets the list of node from the database, for now the values are only an example
+def get_credentials_conninfo() -> Union[None, str]:
+    """Creates the connection string using the postgres section of the credentials file
 
     Returns:
-        returns a dict with the information retrieved from the database
+        returns the connection string, None if the credentials file does not exists
 
     """
     credentials = settings.credentials
     if not credentials:
         credentials = parser.read_ini_file(settings.credentials_file_path)
         if not credentials:
-            return []
+            return None
 
         settings.credentials = credentials
 
-    connection = await create_connection_async(
-        db_name=credentials['local_postgres']['database'],
-        db_host=credentials['local_postgres']['hostname'],
-        db_username=credentials['local_postgres']['user'],
-        db_password=credentials['local_postgres']['password'],
-        db_port=credentials['local_postgres'].getint('port'),
+    section = credentials[settings.postgres_credentials_section]
+    return psycopg.conninfo.make_conninfo(
+        dbname=section['database'], host=section['hostname'],
+        user=section['user'], password=section['password'], port=section.getint('port'),
     )
 
+
+_connection_pool = None
+"""connection pool of the process, created on the first use"""
+
+
+async def get_connection_pool() -> Union[None, psycopg_pool.AsyncConnectionPool]:
+    """Returns the connection pool of the process, creating it if does not exists
+
+    The pool must be used on the background loop, where its connections are created.
+
+    Returns:
+        returns the connection pool, None if the credentials file does not exists
+
+    """
+    global _connection_pool
+    if _connection_pool is None:
+        conn_info = get_credentials_conninfo()
+        if conn_info is None:
+            return None
+
+        logger.log_message("creating postgres connection pool", level=logging.DEBUG)
+        pool = psycopg_pool.AsyncConnectionPool(
+            conn_info,
+            min_size=settings.postgres_pool_min_size,
+            max_size=settings.postgres_pool_max_size,
+            max_lifetime=settings.postgres_pool_max_lifetime_seconds,
+            max_idle=settings.postgres_pool_max_idle_seconds,
+            timeout=settings.postgres_pool_timeout_seconds,
+            # connections broken while idle (database restart, network) are replaced before being used
+            check=psycopg_pool.AsyncConnectionPool.check_connection,
+            open=False,
+        )
+        await pool.open()
+        _connection_pool = pool
+    return _connection_pool
+
+
+@on_background_loop
+async def close_connection_pool():
+    """Closes the connections of the pool, used when the process is stopping"""
+    global _connection_pool
+    if _connection_pool is not None:
+        await _connection_pool.close()
+        _connection_pool = None
+
+
+async def main_aync():
+    return await get_info_from_database('select 1 as teste')
+
+
+@on_background_loop
+async def get_info_from_database(base_query: Query, params: Any = None) -> list:
+    """Gets the list of node from the database, for now the values are only an example
+
+    Returns:
+        returns a list with the rows retrieved from the database, when the query fails or there is
+        no connection the list has a single row with the error, like read_query_async_with_connection
+
+    """
+    try:
+        pool = await get_connection_pool()
+        if pool is None:
+            return [{'error': 1, 'desc': 'failed: no connection pool to postgresql'}]
+
+        async with pool.connection() as connection:
+            return await read_query_async_with_connection(connection, base_query, params=params)
+    except Exception as error:
+        logger.log_message(f'Error to get a connection from the pool: {traceback.format_exc()}', level=logging.ERROR)
+        return [{'error': 1, 'desc': f'failed: {error}'}]
+
+
+@on_background_loop
+async def post_info_into_database(base_query: Query, params: Any = None) -> Union[list, dict]:
+    """
+    Post info on the database, for now the values are only an example
+    """
     res = []
     try:
-        res = await read_query_async_with_connection(connection, base_query, params=params)
+        pool = await get_connection_pool()
+        if pool is None:
+            return []
+
+        async with pool.connection() as connection:
+            res = await write_query_async_with_connection(connection, base_query, params=params)
     except Exception:
-        if connection and not connection.closed:
-            await connection.close()
+        logger.log_message(f'Error to get a connection from the pool: {traceback.format_exc()}', level=logging.ERROR)
 
     if not res:
         return []
@@ -151,38 +323,68 @@ async def get_info_from_database(base_query: Query, params: Any = None) -> list:
     return res
 
 
-async def post_info_into_database(base_query: Query, params: Any = None) -> Union[list, dict]:
-    """
-    Post info on the database, for now the values are only an example
-    """
-    credentials = settings.credentials
-    if not credentials:
-        credentials = parser.read_ini_file(settings.credentials_file_path)
-        if not credentials:
-            return []
 
-        settings.credentials = credentials
+@on_background_loop
+async def post_many_into_database(base_query: Query, params_seq: Iterable[Any]) -> dict:
+    """Writes a batch of rows on the database on a single transaction, see write_many_async_with_connection
 
-    connection = await create_connection_async(
-        db_name=credentials['local_postgres']['database'],
-        db_host=credentials['local_postgres']['hostname'],
-        db_username=credentials['local_postgres']['user'],
-        db_password=credentials['local_postgres']['password'],
-        db_port=credentials['local_postgres'].getint('port'),
-    )
-    res = []
+    Args:
+        base_query (Query): query executed for each row
+        params_seq (Iterable[Any]): params of each execution of the query
+
+    Returns:
+        returns a dictionary with the status of the operation and the number of rows affected
+    """
+    res = {}
     try:
-        res = await write_query_async_with_connection(connection, base_query, params=params)
+        pool = await get_connection_pool()
+        if pool is None:
+            return {}
+
+        async with pool.connection() as connection:
+            res = await write_many_async_with_connection(connection, base_query, params_seq)
     except Exception:
-        if connection and not connection.closed:
-            await connection.close()
+        logger.log_message(f'Error to get a connection from the pool: {traceback.format_exc()}', level=logging.ERROR)
 
-    if not res:
-        return []
+    return res
+
+
+@on_background_loop
+async def copy_rows_into_database(
+        table: str,
+        columns: Sequence[str],
+        rows: Iterable[Sequence],
+        conflict_columns: Sequence[str] = (),
+        update_columns: Sequence[str] = ()) -> dict:
+    """Bulk loads the rows with COPY, see copy_rows_async_with_connection
+
+    Used instead of post_many_into_database for large batches.
+
+    Args:
+        table (str): name of the table, it must have a primary key or unique constraint
+        columns (Sequence[str]): columns of the rows, in the same order
+        rows (Iterable[Sequence]): rows to be loaded
+        conflict_columns (Sequence[str]): columns of the primary key or unique constraint, required with update_columns
+        update_columns (Sequence[str]): columns replaced on the rows that already exist
+
+    Returns:
+        returns a dictionary with the status of the operation and the number of rows inserted or updated
+    """
+    res = {}
+    try:
+        pool = await get_connection_pool()
+        if pool is None:
+            return {}
+
+        async with pool.connection() as connection:
+            res = await copy_rows_async_with_connection(
+                connection, table, columns, rows, conflict_columns, update_columns
+            )
+    except Exception:
+        logger.log_message(f'Error to get a connection from the pool: {traceback.format_exc()}', level=logging.ERROR)
 
     return res
 
 
 if __name__ == '__main__':
-    # asyncio.run(main_aync())
-    main()
+    print(asyncio.run(main_aync()))
@@ -15,6 +15,7 @@ from dataclasses import dataclass
 from config import parser
 from config import logger
 from config import settings
+from databases.background_loop import on_background_loop
 
 
 @dataclass
@@ -28,6 +29,65 @@ class RedisConnectionInfo:
         return f"{self.hostname}:{self.port}"
 
 
+_connection_pools = {}
+"""connection pools of the process, one for each redis instance"""
+_health_check_tasks = {}
+
+
+def _get_pool_key(connection_info: RedisConnectionInfo) -> tuple:
+    return connection_info.hostname, connection_info.port, connection_info.password
+
+
+async def _health_check_loop(pool_key: tuple, pool: redis_async.ConnectionPool):
+    """Pings redis periodically, dropping the idle connections of the pool if redis stops answering"""
+    while True:
+        await asyncio.sleep(settings.redis_health_check_seconds)
+        try:
+            await Redis(connection_pool=pool).ping()
+        except Exception as error:
+            logger.log_message(f"Health check failed for redis {pool_key[0]}:{pool_key[1]}: {error!r}",
+                               level=logging.WARNING)
+            await pool.disconnect(inuse_connections=False)
+
+
+def get_connection_pool(connection_info: RedisConnectionInfo) -> redis_async.ConnectionPool:
+    """Returns the connection pool of the process for the redis instance, creating it if does not exists
+
+    The pool must be used on the background loop, where its connections are created.
+
+    Args:
+        connection_info (RedisConnectionInfo): Object with the connection info
+
+    Returns:
+        returns the connection pool
+    """
+    pool_key = _get_pool_key(connection_info)
+    pool = _connection_pools.get(pool_key)
+    if pool is None:
+        pool = redis_async.BlockingConnectionPool(
+            host=connection_info.hostname,
+            port=connection_info.port,
+            password=connection_info.password or None,
+            max_connections=settings.redis_max_connections,
+            timeout=settings.redis_pool_timeout_seconds,
+            health_check_interval=settings.redis_health_check_seconds,
+        )
+        _connection_pools[pool_key] = pool
+        _health_check_tasks[pool_key] = asyncio.create_task(_health_check_loop(pool_key, pool))
+    return pool
+
+
+@on_background_loop
+async def close_connection_pools():
+    """Closes the connections of every pool of the process, used when the process is stopping"""
+    for task in _health_check_tasks.values():
+        task.cancel()
+    for pool in _connection_pools.values():
+        await pool.disconnect()
+    _health_check_tasks.clear()
+    _connection_pools.clear()
+
+
 async def get_redis_connection_async(
         connection_info: RedisConnectionInfo = None,
         host: str = '',
@@ -35,6 +95,9 @@ async def get_redis_connection_async(
         password: str = '') -> Union[None, Redis]:
     """Creates a connection pool if does not exists and return a connection from this pool
 
+    The connection must be used on the background loop, the functions of this module
+    that receive the connection info already run there.
+
     Args:
         connection_info (RedisConnectionInfo): Object with the connection info, if this is informed the other fields does not need to be informed
         host (str): host of redis instance
@@ -52,19 +115,11 @@ async def get_redis_connection_async(
     if not any([connection_info, host, port, password]):
         raise Exception('The connection information should be informed')
 
-    if connection_info:
-        host = connection_info.hostname
-        port = connection_info.port
-        password = connection_info.password
+    if not connection_info:
+        connection_info = RedisConnectionInfo(host, port, password)
 
     try:
-        redis_conn = await redis_async.Redis(
-            host=host,
-            port=port,
-            password=password
-        )
-
-        await redis_conn.ping()
+        redis_conn = Redis(connection_pool=get_connection_pool(connection_info))
     except:
         logger.log_message(message=f"Error trying to connect to redis: {traceback.print_exc()}", level=logging.ERROR)
         return None
@@ -120,11 +175,31 @@ async def read_dict_from_redis_async(key: str, redis_conn: Redis) -> Union[str,
     return result
 
 
+async def read_value_from_redis_async(key: str, redis_conn: Redis) -> Union[None, bytes]:
+    """Read a raw value from redis, without any conversion
+
+    Args:
+        key (str): redis key
+        redis_conn (redis.Redis): connection with redis
+
+    Returns:
+        returns the value stored on the key, if some error occur or the key does not exists returns None
+
+    """
+    try:
+        return await redis_conn.get(key)
+    except:
+        logger.log_message(f"Error tring to get value from redis {traceback.print_exc()}", level=logging.ERROR)
+        return None
+
+
+@on_background_loop
 async def get_object_from_redis_async(redis_connection_info: RedisConnectionInfo, redis_key: str, close_connection: bool = True) -> dict:
     """Method to make easier the process of getting information from redis
     Args:
         redis_connection_info (RedisConnectionInfo): connection info
         redis_key (str): key to be retrieved
+        close_connection (bool): kept for compatibility, the connections now return to the process pool
     Returns:
         returns a dict with the value stored on redis
 
@@ -150,14 +225,38 @@ async def get_object_from_redis_async(redis_connection_info: RedisConnectionInfo
         result = await read_dict_from_redis_async(key=redis_key, redis_conn=redis_conn)
     except:
         logger.log_message(f"Error tring to retrieve object from redis {traceback.print_exc()}", level=logging.ERROR)
-    finally:
-        if redis_conn and close_connection:
-            await redis_conn.close()
 
     logger.log_message(f'retrieving object from redis: {redis_key}')
     return result
 
 
+@on_background_loop
+async def get_value_from_redis_async(redis_connection_info: RedisConnectionInfo, redis_key: str) -> Union[None, bytes]:
+    """Method to get a raw value from redis, used for small keys like versions and flags
+
+    Args:
+        redis_connection_info (RedisConnectionInfo): connection info
+        redis_key (str): key to be retrieved
+
+    Returns:
+        returns the value stored on redis, None if the key does not exists or if some error occur
+    """
+    redis_conn = None
+    result = None
+    try:
+        redis_conn = await get_redis_connection_async(redis_connection_info)
+        if not redis_conn:
+            logger.log_message("No connection received from method get_redis_connection", level=logging.WARNING)
+            return result
+
+        result = await read_value_from_redis_async(key=redis_key, redis_conn=redis_conn)
+    except:
+        logger.log_message(f"Error tring to retrieve value from redis {traceback.print_exc()}", level=logging.ERROR)
+
+    return result
+
+
+@on_background_loop
 async def set_object_on_redis_async(
         redis_connection_info: RedisConnectionInfo, redis_key: str,
         object_to_save: Union[str, dict], time_to_live: int = 300) -> bool:
@@ -172,13 +271,194 @@ async def set_object_on_redis_async(
         result = await write_object_into_redis_async(key=redis_key, object_to_save=object_to_save, redis_conn=redis_conn, time_to_live=time_to_live)
     except:
         logger.log_message(f"Error tring to retrieve object from redis {traceback.print_exc()}", level=logging.ERROR)
-    finally:
-        if redis_conn:
-            await redis_conn.close()
 
     return result
 
 
+@on_background_loop
+async def get_values_from_redis_async(redis_connection_info: RedisConnectionInfo, redis_keys: list) -> list:
+    """Method to get several raw values from redis on a single round trip
+
+    Args:
+        redis_connection_info (RedisConnectionInfo): connection info
+        redis_keys (list): keys to be retrieved
+
+    Returns:
+        returns a list with the value of each key, None for the keys that do not exist, or a list of None if some error occur
+    """
+    result = [None] * len(redis_keys)
+    try:
+        redis_conn = await get_redis_connection_async(redis_connection_info)
+        if not redis_conn:
+            logger.log_message("No connection received from method get_redis_connection", level=logging.WARNING)
+            return result
+
+        result = await redis_conn.mget(redis_keys)
+    except:
+        logger.log_message(f"Error tring to retrieve values from redis {traceback.print_exc()}", level=logging.ERROR)
+
+    return result
+
+
+@on_background_loop
+async def get_hash_from_redis_async(redis_connection_info: RedisConnectionInfo, redis_key: str) -> dict:
+    """Method to get all the fields of a redis hash
+
+    Args:
+        redis_connection_info (RedisConnectionInfo): connection info
+        redis_key (str): key of the hash
+
+    Returns:
+        returns a dict with the raw fields and values of the hash, empty if some error occur
+    """
+    result = {}
+    try:
+        redis_conn = await get_redis_connection_async(redis_connection_info)
+        if not redis_conn:
+            logger.log_message("No connection received from method get_redis_connection", level=logging.WARNING)
+            return result
+
+        result = await redis_conn.hgetall(redis_key)
+    except:
+        logger.log_message(f"Error tring to retrieve hash from redis {traceback.print_exc()}", level=logging.ERROR)
+
+    return result
+
+
+@on_background_loop
+async def set_hash_fields_on_redis_async(
+        redis_connection_info: RedisConnectionInfo, redis_key: str,
+        fields: dict, counter_key: str = None) -> bool:
+    """Writes the fields into a redis hash on a single pipelined round trip
+
+    Args:
+        redis_connection_info (RedisConnectionInfo): connection info
+        redis_key (str): key of the hash
+        fields (dict): fields and raw values to be written
+        counter_key (str): key incremented on the same pipeline, used to signal the readers that the hash changed
+
+    Returns:
+        returns a boolean with the status of the operation
+    """
+    if not fields:
+        return True
+
+    try:
+        redis_conn = await get_redis_connection_async(redis_connection_info)
+        if not redis_conn:
+            logger.log_message("No connection received from method get_redis_connection", level=logging.WARNING)
+            return False
+
+        async with redis_conn.pipeline(transaction=True) as pipe:
+            pipe.hset(redis_key, mapping=fields)
+            if counter_key:
+                pipe.incr(counter_key)
+            await pipe.execute()
+    except:
+        logger.log_message(f"Error tring to write hash into redis {traceback.print_exc()}", level=logging.ERROR)
+        return False
+
+    return True
+
+
+VERSION_SCORE_DIVISOR = 1000
+"""the versions are in nanoseconds, they are scored in microseconds so the score fits exactly on a double"""
+
+
+def get_version_score(version: int) -> int:
+    return version // VERSION_SCORE_DIVISOR
+
+
+@on_background_loop
+async def publish_version_on_redis_async(
+        redis_connection_info: RedisConnectionInfo, key_prefix: str, pointer_key: str, versions_key: str,
+        version: int, value: bytes, keep_versions: int, keys_to_delete: list = ()) -> bool:
+    """Writes the value on a key of its own version and swaps the pointer to it on a single transaction (MULTI/EXEC)
+
+    The versions are kept on a sorted set by version, the ones older than the last
+    `keep_versions` are removed on the same transaction, so readers never see the
+    pointer or the sorted set referencing a missing key.
+
+    Args:
+        redis_connection_info (RedisConnectionInfo): connection info
+        key_prefix (str): prefix of the versioned keys, the value is written on <key_prefix>:<version>
+        pointer_key (str): key with the current version
+        versions_key (str): sorted set with the versions available, scored by get_version_score
+        version (int): version of the value, must be higher than the previous ones
+        value (bytes): raw value to be written
+        keep_versions (int): number of versions kept, including the new one
+        keys_to_delete (list): keys deleted on the same transaction
+
+    Returns:
+        returns a boolean with the status of the operation
+    """
+    keep_versions = max(keep_versions, 1)
+    try:
+        redis_conn = await get_redis_connection_async(redis_connection_info)
+        if not redis_conn:
+            logger.log_message("No connection received from method get_redis_connection", level=logging.WARNING)
+            return False
+
+        async with redis_conn.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    # the transaction is discarded if another publication changes the versions meanwhile
+                    await pipe.watch(versions_key)
+                    evicted = await pipe.zrange(versions_key, 0, -keep_versions)
+                    pipe.multi()
+                    pipe.set(f'{key_prefix}:{version}', value)
+                    pipe.set(pointer_key, version)
+                    pipe.zadd(versions_key, {version: get_version_score(version)})
+                    if evicted:
+                        pipe.delete(*[f'{key_prefix}:{old_version.decode()}' for old_version in evicted])
+                        pipe.zrem(versions_key, *evicted)
+                    if keys_to_delete:
+                        pipe.delete(*keys_to_delete)
+                    await pipe.execute()
+                    break
+                except redis_async.WatchError:
+                    continue
+    except:
+        logger.log_message(f"Error tring to publish version on redis {traceback.print_exc()}", level=logging.ERROR)
+        return False
+
+    return True
+
+
+@on_background_loop
+async def get_last_version_from_redis_async(
+        redis_connection_info: RedisConnectionInfo, versions_key: str, max_version: int) -> Union[None, bytes]:
+    """Returns the highest version of the sorted set that is not higher than max_version
+
+    Args:
+        redis_connection_info (RedisConnectionInfo): connection info
+        versions_key (str): sorted set with the versions available
+        max_version (int): highest version accepted
+
+    Returns:
+        returns the version, None if there is no version until max_version or if some error occur
+    """
+    try:
+        redis_conn = await get_redis_connection_async(redis_connection_info)
+        if not redis_conn:
+            logger.log_message("No connection received from method get_redis_connection", level=logging.WARNING)
+            return None
+
+        # versions on the same microsecond of max_version share its score, so they are compared by the version
+        max_score = get_version_score(max_version)
+        async with redis_conn.pipeline(transaction=False) as pipe:
+            pipe.zrangebyscore(versions_key, max_score, max_score)
+            pipe.zrevrangebyscore(versions_key, f'({max_score}', '-inf', start=0, num=1)
+            same_score, previous = await pipe.execute()
+        versions = [version for version in same_score if int(version) <= max_version]
+        versions = [max(versions, key=int)] if versions else previous
+    except:
+        logger.log_message(f"Error tring to retrieve version from redis {traceback.print_exc()}", level=logging.ERROR)
+        return None
+
+    return versions[0] if versions else None
+
+
 async def main_async():
     credentials = parser.read_ini_file(settings.credentials_file_path)
     if not credentials:
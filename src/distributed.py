@@ -0,0 +1,284 @@
+"""Module with the redis work queue used to distribute the scrape of the tickers between workers
+
+The coordinator pushes one job per ticker into a redis list, each worker moves a job
+into the processing list, holds a lease on it while the page is fetched and acks it
+writing the page information into the results hash of the run. Jobs with an expired
+lease, from workers that died or got stuck, are put back on the queue by the coordinator.
+"""
+import asyncio
+import logging
+import time
+import traceback
+import uuid
+from typing import Awaitable, Callable, Union
+
+import orjson
+from redis.exceptions import RedisError
+
+from config import settings
+from databases import redis
+from databases.background_loop import on_background_loop
+
+
+def _lease_key(job_id: str) -> str:
+    return f'{settings.distributed_lease_prefix}:{job_id}'
+
+
+def _results_key(run_id: str) -> str:
+    return f'{settings.distributed_results_prefix}:{run_id}'
+
+
+async def get_connection(conn_info: redis.RedisConnectionInfo):
+    """Returns a connection of the pool, raising RedisError if there is no connection, like the other redis failures"""
+    redis_conn = await redis.get_redis_connection_async(conn_info)
+    if redis_conn is None:
+        raise RedisError('no connection received from get_redis_connection_async')
+    return redis_conn
+
+
+def create_job(run_id: str, ticker_general: dict) -> bytes:
+    # json instead of pickle, so whoever can write on redis can not run code on the coordinator or the workers
+    symbol = ticker_general.get('ticker')
+    return orjson.dumps({'id': f'{run_id}:{symbol}', 'run_id': run_id, 'ticker': ticker_general})
+
+
+@on_background_loop
+async def push_jobs(conn_info: redis.RedisConnectionInfo, run_id: str, tickers: list):
+    """Replaces the jobs on the queue by the jobs of the run
+
+    Jobs left by a previous run that did not finish are discarded.
+
+    Args:
+        conn_info (redis.RedisConnectionInfo): connection info
+        run_id (str): identifier of the run
+        tickers (list): tickers information returned by the status invest search
+    """
+    redis_conn = await get_connection(conn_info)
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.delete(settings.distributed_jobs_identifier, settings.distributed_processing_identifier)
+        if tickers:
+            pipe.rpush(settings.distributed_jobs_identifier, *[create_job(run_id, ticker) for ticker in tickers])
+        await pipe.execute()
+
+
+@on_background_loop
+async def get_new_results(conn_info: redis.RedisConnectionInfo, run_id: str, known: set) -> dict:
+    """Returns the page information acked by the workers for the run that is not on known, keyed by the ticker"""
+    redis_conn = await get_connection(conn_info)
+    symbols = [symbol for symbol in await redis_conn.hkeys(_results_key(run_id)) if symbol.decode() not in known]
+    if not symbols:
+        return {}
+
+    values = await redis_conn.hmget(_results_key(run_id), symbols)
+    return {symbol.decode(): orjson.loads(value) for symbol, value in zip(symbols, values) if value is not None}
+
+
+@on_background_loop
+async def delete_results(conn_info: redis.RedisConnectionInfo, run_id: str):
+    redis_conn = await get_connection(conn_info)
+    await redis_conn.delete(_results_key(run_id))
+
+
+@on_background_loop
+async def requeue_expired_jobs(conn_info: redis.RedisConnectionInfo, missing_since: dict) -> int:
+    """Puts back on the queue the jobs being processed without a lease
+
+    A worker sets the lease right after moving the job, so a job is only requeued
+    after staying without a lease for the lease time.
+
+    Args:
+        conn_info (redis.RedisConnectionInfo): connection info
+        missing_since (dict): time each job was first seen without a lease, updated by this function
+
+    Returns:
+        returns the number of jobs requeued
+    """
+    redis_conn = await get_connection(conn_info)
+    jobs = await redis_conn.lrange(settings.distributed_processing_identifier, 0, -1)
+    if not jobs:
+        missing_since.clear()
+        return 0
+
+    job_ids = [orjson.loads(job)['id'] for job in jobs]
+    async with redis_conn.pipeline(transaction=False) as pipe:
+        for job_id in job_ids:
+            pipe.exists(_lease_key(job_id))
+        leases = await pipe.execute()
+
+    now = time.monotonic()
+    requeued = 0
+    for job, job_id, leased in zip(jobs, job_ids, leases):
+        if leased:
+            missing_since.pop(job_id, None)
+            continue
+
+        first_seen = missing_since.setdefault(job_id, now)
+        if now - first_seen < settings.distributed_lease_seconds:
+            continue
+
+        async with redis_conn.pipeline(transaction=True) as pipe:
+            pipe.lrem(settings.distributed_processing_identifier, 1, job)
+            pipe.rpush(settings.distributed_jobs_identifier, job)
+            removed, _ = await pipe.execute()
+        missing_since.pop(job_id, None)
+        requeued += removed
+
+    for job_id in set(missing_since) - set(job_ids):
+        del missing_since[job_id]
+    return requeued
+
+
+async def dispatch_jobs(
+        conn_info: redis.RedisConnectionInfo,
+        tickers: list,
+        on_results: Callable[[str, Union[None, dict]], Awaitable] = None,
+        logger: logging.Logger = logging.getLogger(__name__)) -> dict:
+    """Distributes the tickers between the workers and waits for their page information
+
+    Args:
+        conn_info (redis.RedisConnectionInfo): connection info
+        tickers (list): tickers information returned by the status invest search
+        on_results (Callable[[str, Union[None, dict]], Awaitable]): coroutine function called with the ticker
+            and its page information as soon as the coordinator receives them
+        logger (logging.Logger): logger for the progress of the run
+
+    Returns:
+        returns a dict with the page information of each ticker processed, None for the tickers that failed
+
+    Raises:
+        RedisError:
+            if redis fails or there is no connection, the run must be considered failed
+    """
+    run_id = uuid.uuid4().hex
+    await push_jobs(conn_info, run_id, tickers)
+    logger.info(f'{len(tickers)} jobs sent to the workers on run {run_id}')
+
+    results = {}
+    missing_since = {}
+    deadline = time.monotonic() + settings.distributed_run_timeout_minutes * 60
+    try:
+        while True:
+            new_results = await get_new_results(conn_info, run_id, results.keys())
+            results.update(new_results)
+            if on_results is not None:
+                for symbol, page_results in new_results.items():
+                    await on_results(symbol, page_results)
+
+            if len(results) >= len(tickers):
+                break
+            if time.monotonic() > deadline:
+                logger.warning(f'run {run_id} timed out with {len(results)} of {len(tickers)} jobs done')
+                break
+
+            requeued = await requeue_expired_jobs(conn_info, missing_since)
+            if requeued:
+                logger.warning(f'{requeued} jobs with expired lease put back on the queue')
+            await asyncio.sleep(settings.distributed_poll_seconds)
+
+        return results
+    finally:
+        await delete_results(conn_info, run_id)
+
+
+@on_background_loop
+async def claim_job(conn_info: redis.RedisConnectionInfo, worker_id: str) -> Union[None, dict]:
+    """Moves the next job into the processing list and takes its lease
+
+    Args:
+        conn_info (redis.RedisConnectionInfo): connection info
+        worker_id (str): identifier of the worker, stored on the lease
+
+    Returns:
+        returns the job, None if no job arrived during distributed_poll_seconds
+    """
+    redis_conn = await get_connection(conn_info)
+    raw_job = await redis_conn.blmove(
+        settings.distributed_jobs_identifier,
+        settings.distributed_processing_identifier,
+        settings.distributed_poll_seconds,
+        src='LEFT', dest='RIGHT'
+    )
+    if raw_job is None:
+        return None
+
+    job = orjson.loads(raw_job)
+    await redis_conn.set(_lease_key(job['id']), worker_id, ex=settings.distributed_lease_seconds)
+    job['raw'] = raw_job
+    return job
+
+
+@on_background_loop
+async def renew_lease(conn_info: redis.RedisConnectionInfo, job: dict, worker_id: str):
+    redis_conn = await get_connection(conn_info)
+    await redis_conn.set(_lease_key(job['id']), worker_id, ex=settings.distributed_lease_seconds)
+
+
+@on_background_loop
+async def ack_job(conn_info: redis.RedisConnectionInfo, job: dict, results: Union[None, dict]):
+    """Writes the page information of the job and removes it from the processing list
+
+    Args:
+        conn_info (redis.RedisConnectionInfo): connection info
+        job (dict): job returned by claim_job
+        results (Union[None, dict]): page information collected, None if the job failed
+    """
+    results_key = _results_key(job['run_id'])
+    redis_conn = await get_connection(conn_info)
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.hset(results_key, job['ticker'].get('ticker'), orjson.dumps(results))
+        pipe.expire(results_key, settings.distributed_run_timeout_minutes * 60 * 2)
+        pipe.lrem(settings.distributed_processing_identifier, 1, job['raw'])
+        pipe.delete(_lease_key(job['id']))
+        await pipe.execute()
+
+
+async def run_worker(
+        conn_info: redis.RedisConnectionInfo,
+        fetch_page: Callable[[str], Awaitable[dict]],
+        concurrency: int = 1,
+        logger: logging.Logger = logging.getLogger(__name__)):
+    """Consumes the jobs of the queue until cancelled, keeping up to `concurrency` pages in flight
+
+    Args:
+        conn_info (redis.RedisConnectionInfo): connection info
+        fetch_page (Callable[[str], Awaitable[dict]]): coroutine function that collects the page information of a ticker
+        concurrency (int): number of jobs processed at the same time
+        logger (logging.Logger): logger for the errors
+    """
+    worker_id = uuid.uuid4().hex
+
+    async def keep_lease(job: dict):
+        while True:
+            await asyncio.sleep(settings.distributed_lease_seconds / 3)
+            await renew_lease(conn_info, job, worker_id)
+
+    async def consume():
+        while True:
+            try:
+                job = await claim_job(conn_info, worker_id)
+            except Exception:
+                logger.error(f'error claiming job {traceback.format_exc()}')
+                await asyncio.sleep(settings.distributed_poll_seconds)
+                continue
+
+            if job is None:
+                continue
+
+            symbol = job['ticker'].get('ticker')
+            lease_task = asyncio.create_task(keep_lease(job))
+            try:
+                results = await fetch_page(symbol)
+            except Exception:
+                logger.error(f'error processing {symbol}: {traceback.format_exc()}')
+                results = None
+            finally:
+                lease_task.cancel()
+
+            try:
+                await ack_job(conn_info, job, results)
+            except Exception:
+                # the job stays on the processing list and is requeued when the lease expires
+                logger.error(f'error acking job of {symbol}: {traceback.format_exc()}')
+
+    logger.info(f'Worker {worker_id} waiting for jobs')
+    await asyncio.gather(*[consume() for _ in range(max(concurrency, 1))])
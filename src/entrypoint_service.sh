@@ -1,2 +1,2 @@
 #!/bin/bash
-/usr/local/bin/python magic_formula.py
+/usr/local/bin/python magic_formula.py --mode ${SERVICE_MODE:-standalone}
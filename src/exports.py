@@ -0,0 +1,64 @@
+"""Module to serialize the rankings returned by the api, all of them generated in memory"""
+import datetime
+import io
+
+import numpy as np
+import orjson
+import pandas
+
+
+EXPORT_FORMATS = {
+    'excel': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'csv': ('csv', 'text/csv'),
+    'parquet': ('parquet', 'application/vnd.apache.parquet'),
+}
+"""extension and mimetype of each format accepted on the format parameter"""
+
+
+def get_filename(file_format: str) -> str:
+    extension, _ = EXPORT_FORMATS[file_format]
+    return f'magic_formula_{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}.{extension}'
+
+
+def export_dataframe(tickers_df: pandas.DataFrame, file_format: str) -> io.BytesIO:
+    """Writes the dataframe on a memory buffer using the informed format
+
+    Args:
+        tickers_df (pandas.DataFrame): ranking to be exported
+        file_format (str): one of the formats on EXPORT_FORMATS
+
+    Returns:
+        returns a buffer positioned at the beginning of the file
+
+    """
+    output = io.BytesIO()
+    if file_format == 'excel':
+        # pandas writes the cells column by column, so xlsxwriter can not use constant_memory,
+        # which drops the cells of rows already flushed, the sheet is small enough to be kept in memory
+        with pandas.ExcelWriter(output, engine='xlsxwriter') as writer:
+            tickers_df.to_excel(writer, sheet_name='stocks', index=False, freeze_panes=(1, 0))
+    elif file_format == 'csv':
+        tickers_df.to_csv(output, index=False, encoding='utf-8')
+    elif file_format == 'parquet':
+        tickers_df.to_parquet(output, index=False)
+    else:
+        raise ValueError(f'format {file_format} is not supported')
+
+    output.seek(0)
+    return output
+
+
+def records_to_json(columns: dict) -> bytes:
+    """Encodes the columns as a json list of records, one object per row
+
+    Args:
+        columns (dict): dict with an array for each column, all with the same size
+
+    Returns:
+        returns the encoded json
+
+    """
+    names = list(columns)
+    # tolist converts the numpy scalars to python objects, which orjson encodes natively
+    values = [np.asarray(columns[name]).tolist() for name in names]
+    return orjson.dumps([dict(zip(names, row)) for row in zip(*values)])
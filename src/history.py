@@ -0,0 +1,214 @@
+"""Module with the ingestion of the historical fundamentals and prices of the tickers into postgres"""
+import asyncio
+import datetime
+import logging
+import math
+import traceback
+from typing import Union
+
+import httpx
+
+from config import settings
+from databases import postgres
+import scheduler
+import status_invest
+
+
+logger = logging.getLogger('magic_formula.history')
+
+INDICATOR_HISTORY_TABLE = 'stock_indicator_history'
+INDICATOR_HISTORY_COLUMNS = ('ticker', 'indicator', 'year', 'value')
+INDICATOR_HISTORY_KEY = ('ticker', 'indicator', 'year')
+
+PRICE_HISTORY_TABLE = 'stock_price_history'
+PRICE_HISTORY_COLUMNS = ('ticker', 'date', 'price')
+PRICE_HISTORY_KEY = ('ticker', 'date')
+
+HISTORY_DDL = (
+    f'''CREATE TABLE IF NOT EXISTS {INDICATOR_HISTORY_TABLE} (
+        ticker varchar(12) NOT NULL,
+        indicator varchar(64) NOT NULL,
+        year smallint NOT NULL,
+        value double precision,
+        collected_at timestamptz NOT NULL DEFAULT now(),
+        PRIMARY KEY (ticker, indicator, year)
+    )''',
+    f'''CREATE TABLE IF NOT EXISTS {PRICE_HISTORY_TABLE} (
+        ticker varchar(12) NOT NULL,
+        date date NOT NULL,
+        price double precision NOT NULL,
+        collected_at timestamptz NOT NULL DEFAULT now(),
+        PRIMARY KEY (ticker, date)
+    )''',
+)
+"""tables of the history, created if they do not exist"""
+
+PRICE_DATE_FORMATS = ('%d/%m/%y %H:%M', '%d/%m/%Y %H:%M', '%d/%m/%y', '%d/%m/%Y')
+
+
+def _to_float(value) -> Union[None, float]:
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+
+def _to_date(value: str) -> Union[None, datetime.date]:
+    for date_format in PRICE_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format).date()
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def normalize_indicator_history(ticker: str, payload: dict) -> list:
+    """Converts the answer of the indicators history into rows of INDICATOR_HISTORY_COLUMNS
+
+    Args:
+        ticker (str): ticker symbol
+        payload (dict): json returned by status_invest.get_stocks_historical_info
+
+    Returns:
+        returns a list of tuples with the ticker, indicator, year and value, only the yearly points are kept
+    """
+    data = (payload or {}).get('data') or {}
+    indicators = [item for items in data.values() for item in items] if isinstance(data, dict) else data
+
+    rows = []
+    for indicator in indicators:
+        key = indicator.get('key')
+        for rank in indicator.get('ranks') or []:
+            year = rank.get('rank')
+            if not key or not isinstance(year, int):
+                continue
+            rows.append((ticker, key, year, _to_float(rank.get('value'))))
+    return rows
+
+
+def normalize_price_history(ticker: str, payload: list) -> list:
+    """Converts the answer of the price history into rows of PRICE_HISTORY_COLUMNS
+
+    Args:
+        ticker (str): ticker symbol
+        payload (list): json returned by status_invest.get_stocks_historical_price
+
+    Returns:
+        returns a list of tuples with the ticker, date and price, one for each date
+    """
+    prices = {}
+    for currency in payload or []:
+        for point in currency.get('prices') or []:
+            date, price = _to_date(point.get('date')), _to_float(point.get('price'))
+            if date is not None and price is not None:
+                # the last price of the day is kept when the answer has more than one
+                prices[date] = price
+    return [(ticker, date, price) for date, price in prices.items()]
+
+
+async def fetch_ticker_history(ticker: str, client: httpx.AsyncClient = None) -> tuple:
+    """Collects the indicators and prices history of the ticker at the same time
+
+    Args:
+        ticker (str): ticker symbol
+        client (httpx.AsyncClient): client shared by the requests
+
+    Returns:
+        returns a tuple with the indicators rows and the prices rows
+    """
+    (_, indicators), (_, prices) = await asyncio.gather(
+        status_invest.get_stocks_historical_info(ticker, client),
+        status_invest.get_stocks_historical_price(ticker, client),
+    )
+    return normalize_indicator_history(ticker, indicators.json()), normalize_price_history(ticker, prices.json())
+
+
+async def create_history_tables() -> bool:
+    for statement in HISTORY_DDL:
+        res = await postgres.post_info_into_database(statement)
+        if not res or res.get('error'):
+            return False
+    return True
+
+
+async def load_history(tickers: list, client: httpx.AsyncClient = None) -> dict:
+    """Collects the history of the tickers and upserts the points into postgres
+
+    The rows are loaded with COPY every history_copy_batch_rows rows, so the memory
+    used does not depend on the number of tickers. Points already stored are updated
+    when the value changed, the indicators of the current year and the prices of the
+    current day change until they are closed.
+
+    Args:
+        tickers (list): ticker symbols
+        client (httpx.AsyncClient): client shared by the requests
+
+    Returns:
+        returns a dict with the number of rows inserted or updated on each table
+    """
+    buffers = {INDICATOR_HISTORY_TABLE: [], PRICE_HISTORY_TABLE: []}
+    columns = {INDICATOR_HISTORY_TABLE: INDICATOR_HISTORY_COLUMNS, PRICE_HISTORY_TABLE: PRICE_HISTORY_COLUMNS}
+    keys = {INDICATOR_HISTORY_TABLE: INDICATOR_HISTORY_KEY, PRICE_HISTORY_TABLE: PRICE_HISTORY_KEY}
+    inserted = {INDICATOR_HISTORY_TABLE: 0, PRICE_HISTORY_TABLE: 0}
+
+    async def flush(table: str, minimum_rows: int = 1):
+        rows = buffers[table]
+        if len(rows) < minimum_rows:
+            return
+        buffers[table] = []
+        res = await postgres.copy_rows_into_database(
+            table, columns[table], rows, conflict_columns=keys[table],
+            update_columns=[column for column in columns[table] if column not in keys[table]],
+        )
+        inserted[table] += res.get('rows', 0)
+
+    async def process_ticker(ticker: str):
+        indicators, prices = await fetch_ticker_history(ticker, client)
+        buffers[INDICATOR_HISTORY_TABLE].extend(indicators)
+        buffers[PRICE_HISTORY_TABLE].extend(prices)
+        for table in buffers:
+            await flush(table, settings.history_copy_batch_rows)
+
+    await scheduler.run_bounded(
+        tickers,
+        process_ticker,
+        concurrency=settings.parallel_number_requests,
+        logger=logger,
+    )
+    for table in buffers:
+        await flush(table)
+
+    logger.info(f'History loaded for {len(tickers)} tickers: {inserted}')
+    return inserted
+
+
+async def refresh_history(client: httpx.AsyncClient = None) -> dict:
+    """Loads the history of every ticker of the status invest search"""
+    if not await create_history_tables():
+        logger.warning('History tables could not be created, history not loaded')
+        return {}
+
+    tickers = [stock.get('ticker') for stock in await status_invest.get_stocks_info(client)]
+    return await load_history(tickers, client)
+
+
+async def refresh_history_loop(client: httpx.AsyncClient = None):
+    """Keeps the history refreshed on the background while the service is running"""
+    while True:
+        try:
+            await refresh_history(client)
+        except Exception:
+            logger.error(f'error refreshing history {traceback.format_exc()}')
+        await asyncio.sleep(settings.history_refresh_hours * 60 * 60)
+
+
+async def main():
+    try:
+        await refresh_history()
+    finally:
+        await postgres.close_connection_pool()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,94 @@
+"""Module with the cache of http responses revalidated with conditional requests"""
+import threading
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Union
+
+import httpx
+
+
+STRIPPED_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding'}
+"""headers not kept on the stored responses, the content is already decoded so they do not apply to the stored copy"""
+
+
+def get_stored_headers(response: httpx.Response) -> list:
+    """Returns the headers of the response that are kept when it is stored, as a list of (key, value)"""
+    return [(key, value) for key, value in response.headers.items() if key.lower() not in STRIPPED_HEADERS]
+
+
+@dataclass
+class CachedResponse:
+    """Response stored with the validators sent by the server"""
+    etag: Union[None, str]
+    last_modified: Union[None, str]
+    headers: dict
+    compressed_content: bytes
+    parsed: Any = None
+    """result of parsing the content, reused while the server answers 304"""
+
+    @property
+    def content(self) -> bytes:
+        return zlib.decompress(self.compressed_content)
+
+    def to_response(self, request: httpx.Request = None) -> httpx.Response:
+        """Rebuilds the original response, used when the server answers 304 Not Modified"""
+        return httpx.Response(200, headers=self.headers, content=self.content, request=request)
+
+
+class ConditionalCache:
+    """LRU of responses with ETag or Last-Modified, used to send If-None-Match and If-Modified-Since"""
+
+    def __init__(self, max_entries: int = 1000) -> None:
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> Union[None, CachedResponse]:
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            return entry
+
+    def conditional_headers(self, entry: Union[None, CachedResponse]) -> dict:
+        """Returns the headers to revalidate the cached response
+
+        Args:
+            entry (Union[None, CachedResponse]): response returned by get
+
+        Returns:
+            returns a dict with the conditional headers, empty if there is nothing cached
+        """
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def store(self, url: str, response: httpx.Response) -> Union[None, CachedResponse]:
+        """Stores the response if it has validators
+
+        Args:
+            url (str): url of the request
+            response (httpx.Response): response received
+
+        Returns:
+            returns the stored entry, None if the response can not be revalidated
+        """
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if response.status_code != 200 or not (etag or last_modified):
+            return None
+
+        headers = dict(get_stored_headers(response))
+        entry = CachedResponse(etag, last_modified, headers, zlib.compress(response.content, 1))
+        with self._lock:
+            self._entries[url] = entry
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
@@ -0,0 +1,53 @@
+"""Module to keep in memory the tickers of each index published by the service"""
+import hashlib
+import time
+from typing import Union
+
+import orjson
+
+from config import settings
+from databases import redis
+
+
+class IndexMembershipCache:
+    """Copy of the indexes tickers kept by each api worker, reloaded from redis periodically"""
+
+    def __init__(self,
+                 identifier: str = settings.indexes_identifier,
+                 refresh_seconds: int = settings.api_indexes_refresh_seconds) -> None:
+        self.identifier = identifier
+        self.refresh_seconds = refresh_seconds
+        # tickers and version are swapped together so concurrent requests never see a mixed state
+        self._members = ({}, None)
+        self._loaded_at = None
+
+    @staticmethod
+    def get_members_version(members: dict) -> str:
+        """Hash of the tickers of every index, it only changes when some index changes"""
+        normalized = {index: sorted(tickers) for index, tickers in sorted(members.items())}
+        return hashlib.sha1(orjson.dumps(normalized)).hexdigest()
+
+    async def get_versioned(self, conn_info: redis.RedisConnectionInfo) -> tuple:
+        """Returns the tickers of each index and their version, reloading from redis if the copy is older than refresh_seconds
+
+        Args:
+            conn_info (redis.RedisConnectionInfo): connection info
+
+        Returns:
+            returns a tuple with a dict with a set of tickers for each index, empty if the service did not
+            publish them yet, and the version of the tickers, None if they were not published
+        """
+        now = time.monotonic()
+        if self._loaded_at is not None and now - self._loaded_at < self.refresh_seconds:
+            return self._members
+
+        members = await redis.get_object_from_redis_async(conn_info, self.identifier)
+        if members:
+            self._members = (members, self.get_members_version(members))
+        self._loaded_at = now
+        return self._members
+
+    async def get(self, conn_info: redis.RedisConnectionInfo) -> dict:
+        """Returns the tickers of each index, see get_versioned"""
+        members, _ = await self.get_versioned(conn_info)
+        return members
@@ -1,11 +1,22 @@
+import argparse
 import asyncio
 import math
 import time
 import logging
 import traceback
+from typing import AsyncIterable, Awaitable, Callable, Union
+
+import httpx
+import numpy as np
+from redis.exceptions import RedisError
 
 from config import settings, parser
-from databases import redis
+from databases import postgres, redis
+import distributed
+import history
+import scheduler
+import snapshot
+from scrape_state import ScrapeState
 import status_invest
 
 
@@ -87,22 +98,84 @@ async def calculate_graham_upside(
     return round(pre_vi, 2)
 
 
-async def process_ticker_info(ticker_general: dict) -> list:
-    """Process the information on the ticker and return the relevant fields
+def calculate_graham_vi_array(
+        vpa: np.ndarray,
+        lpa: np.ndarray,
+        max_p_l: float = 15,
+        max_p_vp: float = 1.5) -> np.ndarray:
+    """Calculates the Graham VI for a whole column of stocks at once, following the same rules of calculate_graham_vi
 
     Args:
-        ticker_general (dict): ticker information collected on status invest
+        vpa (np.ndarray): book value per share of each stock
+        lpa (np.ndarray): earnings per share of each stock
+        max_p_l (float): maximum P/L used on the formula
+        max_p_vp (float): maximum P/VP used on the formula
 
     Returns:
-        returns a list with the fields calculated for the ticker
+        returns an array with the Graham VI of each stock, 0 where it can not be calculated
 
     """
-    symbol = ticker_general.get('ticker', 'Not found')
+    vpa = np.asarray(vpa, dtype=np.float64)
+    lpa = np.asarray(lpa, dtype=np.float64)
+    pre_vi = (max_p_l * max_p_vp) * vpa * lpa
+
+    invalid = (vpa <= 0) | (lpa <= 0) | (pre_vi < 0)
+    with np.errstate(invalid='ignore'):
+        graham_vi = np.where(invalid, 0.0, np.sqrt(pre_vi))
+
+    return np.round(graham_vi, 2)
+
+
+def calculate_graham_upside_array(
+        current_price: np.ndarray,
+        graham_vi: np.ndarray) -> np.ndarray:
+    """Calculates the Graham upside for a whole column of stocks at once, following the same rules of calculate_graham_upside
+
+    Args:
+        current_price (np.ndarray): current price of each stock
+        graham_vi (np.ndarray): intrinsic value of each stock calculated using graham method
 
-    logger.info(f'Starting process for ticker {symbol}')
-    page = await status_invest.get_stocks_page_info(symbol)
-    results = await status_invest.format_stock_page(page[1].content, logger)
-    ticker_general.update(results)
+    Returns:
+        returns an array with the Graham upside of each stock, 0 where it can not be calculated
+
+    """
+    current_price = np.asarray(current_price, dtype=np.float64)
+    graham_vi = np.asarray(graham_vi, dtype=np.float64)
+
+    invalid = (current_price <= 0) | (graham_vi <= 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        upside = np.where(invalid, 0.0, (graham_vi - current_price) / current_price)
+
+    return np.round(upside, 2)
+
+
+async def fetch_ticker_page(symbol: str, client: httpx.AsyncClient = None) -> Union[None, dict]:
+    """Collects and parses the page of the ticker on status invest
+
+    Args:
+        symbol (str): ticker symbol
+        client (httpx.AsyncClient): client shared by the requests of the scrape
+
+    Returns:
+        returns a dict with the information found on the page, None if the page could not be parsed
+
+    """
+    return await status_invest.get_stock_page_results(symbol, client, logger)
+
+
+async def build_ticker_info(ticker_general: dict, page_results: dict) -> dict:
+    """Calculates the fields of the ticker using the search information and the page information
+
+    Args:
+        ticker_general (dict): ticker information collected on status invest search
+        page_results (dict): information collected on the ticker page
+
+    Returns:
+        returns a dict with the fields calculated for the ticker, keyed by the snapshot columns
+
+    """
+    symbol = ticker_general.get('ticker', 'Not found')
+    ticker_general = {**ticker_general, **page_results}
 
     roic = ticker_general.get('roic', 0)
     vpa = ticker_general.get('vpa', 0)
@@ -118,28 +191,192 @@ async def process_ticker_info(ticker_general: dict) -> list:
     graham_vi = await calculate_graham_vi(vpa, lpa)
     graham_upside = await calculate_graham_upside(current_price, graham_vi)
 
-    ticker_info = [
-        symbol,
-        roic,
-        vpa,
-        lpa,
-        p_l,
-        p_vp,
-        dividend_yield,
-        current_price,
-        ey,
-        graham_vi,
-        graham_upside,
-        ebit,
-        market_cap
-    ]
-    logger.info(f'Finishing process for ticker {symbol}')
+    ticker_info = {
+        'symbol': symbol,
+        'roic': roic,
+        'vpa': vpa,
+        'lpa': lpa,
+        'p_l': p_l,
+        'p_vp': p_vp,
+        'dividend_yield': dividend_yield,
+        'current_price': current_price,
+        'earning_yield': ey,
+        'graham_vi': graham_vi,
+        'graham_upside': graham_upside,
+        'ebit': ebit,
+        'market_cap': market_cap,
+    }
     return ticker_info
 
 
-async def main():
-    logger.info('Starting process')
-    identifier = 'magic_formula_main_data'
+async def fetch_pages_locally(
+        tickers: Union[list, AsyncIterable],
+        on_page: Callable[[str, dict], Awaitable] = None,
+        client: httpx.AsyncClient = None) -> dict:
+    """Collects the pages of the tickers on this process
+
+    Args:
+        tickers (Union[list, AsyncIterable]): tickers information returned by the status invest search, processed as they arrive
+        on_page (Callable[[str, dict], Awaitable]): coroutine function called with the ticker and its page information as soon as it is collected
+        client (httpx.AsyncClient): client shared by the requests of the scrape
+
+    Returns:
+        returns a dict with the page information of each ticker processed
+
+    """
+    async def fetch_page(ticker_general: dict) -> tuple:
+        symbol = ticker_general.get('ticker', 'Not found')
+        logger.info(f'Starting process for ticker {symbol}')
+        results = await fetch_ticker_page(symbol, client)
+        if on_page is not None:
+            await on_page(symbol, results)
+        logger.info(f'Finishing process for ticker {symbol}')
+        return symbol, results
+
+    pages = await scheduler.run_bounded(
+        tickers,
+        fetch_page,
+        concurrency=settings.parallel_number_requests,
+        interval=settings.request_interval_seconds,
+        logger=logger,
+        item_name=lambda ticker: ticker.get('ticker'),
+    )
+    return dict(pages)
+
+
+async def scrape_tickers(
+        universe: Union[list, AsyncIterable],
+        scrape_state: ScrapeState,
+        client: httpx.AsyncClient = None,
+        fetch_pages: Callable[[AsyncIterable, Callable], Awaitable[dict]] = None,
+        publisher: snapshot.LiveTickerPublisher = None) -> list:
+    """Process the tickers of the search, only fetching the pages that changed since the previous run
+
+    Tickers with the same search information and a recent page reuse the page information
+    of the previous run, the same happens for the tickers that fail on this run. When the
+    universe is an async iterable the pages are fetched while the search is downloaded.
+
+    Args:
+        universe (Union[list, AsyncIterable]): tickers information returned by the status invest search
+        scrape_state (ScrapeState): pages collected on the previous runs
+        client (httpx.AsyncClient): client shared by the requests of the scrape
+        fetch_pages (Callable[[AsyncIterable, Callable], Awaitable[dict]]): coroutine function that collects the pages
+            of the tickers, calling the callback received for each page as soon as it is collected and returning the page
+            information by ticker, if not informed the pages are collected on this process
+        publisher (snapshot.LiveTickerPublisher): publisher of the tickers while the run is in progress
+
+    Returns:
+        returns a list with the fields calculated for each ticker
+
+    """
+    scrape_state.start_run()
+    symbols, to_fetch, to_reuse = [], [], []
+    tickers_by_symbol = {}
+    stocks_data = []
+
+    async def tickers_to_fetch():
+        async for ticker_general in scheduler.iterate_items(universe):
+            symbols.append(ticker_general.get('ticker'))
+            if scrape_state.needs_fetch(ticker_general):
+                tickers_by_symbol[ticker_general.get('ticker')] = ticker_general
+                to_fetch.append(ticker_general)
+                yield ticker_general
+            else:
+                to_reuse.append(ticker_general)
+
+    async def on_page(symbol: str, results: dict):
+        ticker_general = tickers_by_symbol.get(symbol)
+        if ticker_general is None or results is None:
+            return
+
+        scrape_state.store(ticker_general, results)
+        ticker_info = await build_ticker_info(ticker_general, results)
+        stocks_data.append(ticker_info)
+        if publisher is not None:
+            try:
+                await publisher.add(ticker_info)
+            except Exception:
+                logger.error(f'error publishing ticker {symbol} {traceback.format_exc()}')
+
+    if fetch_pages is None:
+        pages = await fetch_pages_locally(tickers_to_fetch(), on_page, client)
+    else:
+        pages = await fetch_pages(tickers_to_fetch(), on_page)
+    logger.info(f'{len(to_fetch)} tickers fetched, {len(to_reuse)} reused from previous runs')
+
+    failed = [ticker for ticker in to_fetch if pages.get(ticker.get('ticker')) is None]
+    for ticker_general in to_reuse + failed:
+        page_results = scrape_state.get_results(ticker_general.get('ticker'))
+        if page_results is not None:
+            stocks_data.append(await build_ticker_info(ticker_general, page_results))
+
+    logger.info(f'{scrape_state.changed_pages} pages changed, {len(failed)} tickers failed')
+    scrape_state.prune(symbols)
+    return stocks_data
+
+
+async def refresh_indexes(
+        conn_info: redis.RedisConnectionInfo,
+        index_members: dict,
+        client: httpx.AsyncClient = None) -> dict:
+    """Collects the tickers of every index and publishes them on redis for the api
+
+    Args:
+        conn_info (redis.RedisConnectionInfo): connection info
+        index_members (dict): tickers collected on the previous refresh, kept for the indexes that fail
+        client (httpx.AsyncClient): client shared by the requests of the scrape
+
+    Returns:
+        returns a dict with a set of tickers for each index
+
+    """
+    logger.info('Refreshing indexes tickers')
+    index_members = {**index_members, **await status_invest.get_all_indexes_info(logger, client)}
+    if index_members:
+        await redis.set_object_on_redis_async(
+            conn_info, settings.indexes_identifier, index_members,
+            time_to_live=settings.indexes_ttl_minutes * 60
+        )
+    return index_members
+
+
+async def refresh_indexes_loop(conn_info: redis.RedisConnectionInfo, client: httpx.AsyncClient = None):
+    """Keeps the indexes tickers refreshed on the background while the service is running"""
+    index_members = {}
+    while True:
+        try:
+            index_members = await refresh_indexes(conn_info, index_members, client)
+        except Exception:
+            logger.error(f'error refreshing indexes {traceback.format_exc()}')
+        await asyncio.sleep(settings.indexes_refresh_minutes * 60)
+
+
+async def run_worker(conn_info: redis.RedisConnectionInfo):
+    """Processes the ticker pages distributed by the coordinator until the process is stopped"""
+    client = status_invest.create_client()
+    try:
+        await distributed.run_worker(
+            conn_info,
+            lambda symbol: fetch_ticker_page(symbol, client),
+            concurrency=settings.parallel_number_requests,
+            logger=logger,
+        )
+    finally:
+        await client.aclose()
+        status_invest.shutdown_parser_pool()
+        await redis.close_connection_pools()
+
+
+async def main(mode: str = settings.service_mode):
+    """Runs the service
+
+    Args:
+        mode (str): standalone collects every ticker on this process, coordinator distributes
+            the tickers to the workers and publishes the results, worker processes the tickers
+            distributed by the coordinator
+
+    """
+    logger.info(f'Starting process on {mode} mode')
 
     credentials = parser.read_ini_file(settings.credentials_file_path)
     if not credentials:
@@ -151,34 +388,78 @@ async def main():
         settings.credentials['redis'].getint('port'),
         settings.credentials['redis']['password'],
     )
+    if mode == 'worker':
+        await run_worker(conn_info)
+        return
 
-    while True:
-        stocks_data = []
-        tasks = []
-
-        logger.info('Processing stock information')
-        resp = await status_invest.get_stocks_info()
-        for ticker in resp.json().get('list', []):
-            tasks.append(process_ticker_info(ticker))
-            if len(tasks) > settings.parallel_number_requests and not settings.use_cache:
-                try:
-                    stocks_data += await asyncio.gather(*tasks)
-                    time.sleep(0.1)
-
-                except:
-                    logger.error(f'error tring to collect information{traceback.print_exc()}')
-                tasks = []
-
-        if tasks:
-            stocks_data += await asyncio.gather(*tasks)
-
-        logger.info('writing into redis')
-        await redis.set_object_on_redis_async(conn_info, identifier, stocks_data, time_to_live=None)
+    fetch_pages = None
+    if mode == 'coordinator':
+        async def fetch_pages(tickers: AsyncIterable, on_page: Callable) -> dict:
+            # the jobs are sent together, so the coordinator waits for the whole search
+            tickers = [ticker async for ticker in tickers]
+            return await distributed.dispatch_jobs(conn_info, tickers, on_page, logger)
+
+    # a single client is used for the whole service, so the connections to status invest are reused
+    client = status_invest.create_client()
+    indexes_task = asyncio.create_task(refresh_indexes_loop(conn_info, client))
+    history_task = asyncio.create_task(history.refresh_history_loop(client)) if settings.history_enabled else None
+    scrape_state = ScrapeState(
+        max_age_seconds=settings.ticker_page_max_age_minutes * 60 if settings.incremental_scrape else 0,
+        ignored_fields=settings.fingerprint_ignored_fields,
+    )
 
-        logger.info('Waiting for next itteration')
-        time.sleep(settings.time_to_sleep_minutes * 60)
+    try:
+        while True:
+            logger.info('Processing stock information')
+            # the tickers are written on redis as soon as they are processed, so a long or interrupted run
+            # does not leave the api with the information of the previous run
+            publisher = snapshot.LiveTickerPublisher(conn_info)
+            try:
+                # the pages of the tickers are fetched while the search pages are still arriving
+                stocks_data = await scrape_tickers(
+                    status_invest.iter_stocks_info(client), scrape_state, client, fetch_pages, publisher
+                )
+            except httpx.HTTPError:
+                logger.error(f'error collecting the stocks list, waiting for next itteration {traceback.format_exc()}')
+                stocks_data = None
+            except RedisError:
+                # only the coordinator uses redis during the scrape, to distribute the jobs
+                logger.error(f'error distributing the jobs, waiting for next itteration {traceback.format_exc()}')
+                stocks_data = None
+            finally:
+                # the tickers processed are written even if the run failed, and before the snapshot
+                # is published, since the publication removes the live tickers
+                await publisher.close()
+
+            if stocks_data is None:
+                await asyncio.sleep(settings.time_to_sleep_minutes * 60)
+                continue
+
+            logger.info('writing into redis')
+            columns = snapshot.build_columns(stocks_data)
+            version = time.time_ns()
+            # data and version are written on the same transaction, the api caches are only invalidated with the new data available
+            await snapshot.publish_snapshot(conn_info, columns, version)
+            if settings.persist_snapshot_postgres:
+                await snapshot.persist_snapshot(version, columns)
+
+            logger.info('Waiting for next itteration')
+            await asyncio.sleep(settings.time_to_sleep_minutes * 60)
+    finally:
+        indexes_task.cancel()
+        if history_task is not None:
+            history_task.cancel()
+        await client.aclose()
+        status_invest.shutdown_parser_pool()
+        await redis.close_connection_pools()
+        await postgres.close_connection_pool()
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    arg_parser = argparse.ArgumentParser(description='Collects the stocks information and publishes it on redis')
+    arg_parser.add_argument(
+        '--mode', choices=['standalone', 'coordinator', 'worker'], default=settings.service_mode,
+        help='standalone collects every ticker, coordinator distributes the tickers to the workers'
+    )
+    asyncio.run(main(arg_parser.parse_args().mode))
 
@@ -0,0 +1,95 @@
+"""Module with the ranking engine of the magic formula, working directly over the snapshot columns"""
+import numpy as np
+
+
+RANKING_COLUMNS = ['roic_index_number', 'earning_yield_index', 'magic_index']
+"""columns added to the stocks information by the ranking"""
+
+
+def rank_descending(values: np.ndarray) -> np.ndarray:
+    """Returns the position of each value when ordered from the highest to the lowest
+
+    Ties keep the original order and nan values go to the end. The ranking is done
+    over the last axis, so a 2d array is ranked row by row.
+
+    Args:
+        values (np.ndarray): values to be ranked
+
+    Returns:
+        returns an array of the same shape with the rank of each value, starting on 0
+    """
+    values = np.asarray(values, dtype=np.float64)
+    # lexsort is stable and uses the last key as the primary one
+    order = np.lexsort((-values, np.isnan(values)), axis=-1)
+
+    ranks = np.empty(values.shape, dtype=np.int64)
+    positions = np.broadcast_to(np.arange(values.shape[-1]), values.shape)
+    np.put_along_axis(ranks, order, positions, axis=-1)
+    return ranks
+
+
+def calculate_magic_index(roic: np.ndarray, earning_yield: np.ndarray, roic_ignore: int = 0) -> tuple:
+    """Calculates the rank vectors of the magic formula
+
+    Args:
+        roic (np.ndarray): return on invested capital of each stock
+        earning_yield (np.ndarray): earning yield of each stock
+        roic_ignore (int): if informed the roic is not used on the formula
+
+    Returns:
+        returns a tuple with the roic rank, the earning yield rank and the magic index
+    """
+    earning_yield_index = rank_descending(earning_yield)
+    if roic_ignore:
+        roic_index = np.zeros_like(earning_yield_index)
+    else:
+        roic_index = rank_descending(roic)
+
+    return roic_index, earning_yield_index, roic_index + earning_yield_index
+
+
+def select_top(magic_index: np.ndarray, earning_yield_index: np.ndarray, number_of_stocks: int = 0) -> np.ndarray:
+    """Returns the positions of the best stocks ordered by the magic index
+
+    Ties on the magic index are decided by the earning yield rank, which is unique,
+    so the same input always returns the same order.
+
+    Args:
+        magic_index (np.ndarray): magic index of each stock
+        earning_yield_index (np.ndarray): earning yield rank of each stock
+        number_of_stocks (int): quantity of stocks to be returned, 0 returns all of them
+
+    Returns:
+        returns the positions of the selected stocks
+    """
+    size = len(magic_index)
+    sort_key = magic_index * max(size, 1) + earning_yield_index
+    if not number_of_stocks or number_of_stocks >= size:
+        return np.argsort(sort_key, kind='stable')
+
+    # only the selected stocks are sorted, the rest is just partitioned
+    selected = np.argpartition(sort_key, number_of_stocks - 1)[:number_of_stocks]
+    return selected[np.argsort(sort_key[selected], kind='stable')]
+
+
+def rank_stocks(columns: dict, number_of_stocks: int = 0, roic_ignore: int = 0) -> dict:
+    """Ranks the stocks using the magic formula
+
+    Args:
+        columns (dict): dict with the columns of the stocks information
+        number_of_stocks (int): quantity of stocks to be returned, 0 returns all of them
+        roic_ignore (int): if informed the roic is not used on the formula
+
+    Returns:
+        returns a dict with the columns of the selected stocks, ordered by the magic index,
+        including the columns on RANKING_COLUMNS
+    """
+    roic_index, earning_yield_index, magic_index = calculate_magic_index(
+        columns['roic'], columns['earning_yield'], roic_ignore
+    )
+    selected = select_top(magic_index, earning_yield_index, number_of_stocks)
+
+    ranked = {name: column[selected] for name, column in columns.items()}
+    for name, values in zip(RANKING_COLUMNS, (roic_index, earning_yield_index, magic_index)):
+        ranked[name] = values[selected]
+    return ranked
@@ -0,0 +1,157 @@
+"""Module with the rate limiter and the retry policy of the requests to status invest"""
+import asyncio
+import datetime
+import email.utils
+import logging
+import random
+import threading
+import time
+from typing import Union
+
+import httpx
+
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+"""status codes that are retried, 429 and 503 also mean the server is asking to slow down"""
+
+
+class AdaptiveRateLimiter:
+    """Token bucket with the rate adapted to the answers of the server (AIMD)
+
+    Every response under the target latency increases the rate by a fixed step,
+    throttling answers (429, 5xx, timeouts) cut it by a factor and slow answers cut
+    it by a smaller factor, so the scrape converges to the highest rate the server
+    accepts.
+    """
+
+    def __init__(self,
+                 rate: float,
+                 min_rate: float,
+                 max_rate: float,
+                 burst: int = 1,
+                 increase_step: float = 0.1,
+                 decrease_factor: float = 0.5,
+                 target_latency: float = 2.0,
+                 latency_decrease_factor: float = 0.9) -> None:
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.target_latency = target_latency
+        self.latency_decrease_factor = latency_decrease_factor
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        # a threading lock, the limiter can be used by different event loops
+        self._lock = threading.Lock()
+
+    async def acquire(self):
+        """Waits until a request can be sent"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # the token is reserved before waiting, so concurrent callers queue one after the other
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def on_success(self, latency: float):
+        with self._lock:
+            if latency > self.target_latency:
+                self.rate = max(self.min_rate, self.rate * self.latency_decrease_factor)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+
+
+def get_retry_after(response: httpx.Response) -> Union[None, float]:
+    """Reads the Retry-After header, that can be informed in seconds or as a date
+
+    Args:
+        response (httpx.Response): response received
+
+    Returns:
+        returns the seconds to wait, None if the header is not informed or is invalid
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+
+    if value.strip().isdigit():
+        return float(value)
+
+    try:
+        retry_date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_date - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0.0)
+
+
+def get_backoff(attempt: int, base: float, maximum: float) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+async def request_with_retry(
+        client: httpx.AsyncClient,
+        method: str,
+        url: str,
+        limiter: AdaptiveRateLimiter,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+        logger: logging.Logger = logging.getLogger(__name__),
+        **kwargs) -> httpx.Response:
+    """Sends the request respecting the rate limiter, retrying throttled and failed requests
+
+    Args:
+        client (httpx.AsyncClient): client used for the request
+        method (str): http method
+        url (str): url to be requested
+        limiter (AdaptiveRateLimiter): rate limiter shared by the requests
+        max_retries (int): maximum number of retries after the first attempt
+        backoff_base (float): base of the exponential backoff in seconds
+        backoff_max (float): maximum wait between the attempts in seconds
+        logger (logging.Logger): logger for the retries
+        **kwargs: arguments sent to client.request
+
+    Returns:
+        returns the response, after the last attempt it is returned even if it failed
+
+    Raises:
+        httpx.TransportError:
+            if the last attempt fails without a response
+    """
+    for attempt in range(max_retries + 1):
+        await limiter.acquire()
+        start = time.monotonic()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.TransportError as error:
+            limiter.on_throttle()
+            if attempt == max_retries:
+                raise
+            delay = get_backoff(attempt, backoff_base, backoff_max)
+            logger.warning(f'{error!r} requesting {url}, retrying in {delay:.2f} seconds')
+            await asyncio.sleep(delay)
+            continue
+
+        if response.status_code not in RETRY_STATUS_CODES:
+            limiter.on_success(time.monotonic() - start)
+            return response
+
+        limiter.on_throttle()
+        if attempt == max_retries:
+            return response
+
+        retry_after = get_retry_after(response)
+        delay = min(retry_after, backoff_max) if retry_after is not None else get_backoff(attempt, backoff_base, backoff_max)
+        logger.warning(f'status {response.status_code} requesting {url}, retrying in {delay:.2f} seconds')
+        await asyncio.sleep(delay)
@@ -0,0 +1,61 @@
+"""Module with the in-process cache for the rankings served by the api"""
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class ResultCache:
+    """LRU cache for ranking results bound to a version of the stocks information
+
+    Every entry is stored with the version used to calculate it, the published
+    versions never change, so entries of different versions live together and the
+    ones of versions no longer requested are evicted as the least recently used.
+    """
+
+    def __init__(self, max_entries: int = 256) -> None:
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, version: Any, key: Hashable) -> Any:
+        """Returns the value stored for the key on the informed version
+
+        Args:
+            version (Any): version of the stocks information
+            key (Hashable): normalized parameters of the request
+
+        Returns:
+            returns the cached value, if not found returns None
+        """
+        if version is None:
+            return None
+
+        with self._lock:
+            value = self._entries.get((version, key))
+            if value is not None:
+                self._entries.move_to_end((version, key))
+            return value
+
+    def set(self, version: Any, key: Hashable, value: Any) -> None:
+        """Stores the value for the key, evicting the least recently used entries if needed
+
+        Args:
+            version (Any): version of the stocks information used to calculate the value
+            key (Hashable): normalized parameters of the request
+            value (Any): value to be cached
+        """
+        if version is None or self.max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries[(version, key)] = value
+            self._entries.move_to_end((version, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
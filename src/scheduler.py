@@ -0,0 +1,98 @@
+"""Module with the scheduler used to run the scrape tasks with bounded concurrency"""
+import asyncio
+import logging
+import traceback
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Iterable, Union
+
+
+_DONE = object()
+
+
+class Pacer:
+    """Spaces the start of the tasks by a minimum interval without blocking the event loop"""
+
+    def __init__(self, interval: float = 0.0) -> None:
+        self.interval = interval
+        self._next_start = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        if self.interval <= 0:
+            return
+
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            delay = self._next_start - now
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_start = max(now, self._next_start) + self.interval
+
+
+async def iterate_items(items: Union[Iterable, AsyncIterable]) -> AsyncIterator:
+    """Iterates over sync and async iterables the same way"""
+    if hasattr(items, '__aiter__'):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+async def run_bounded(
+        items: Union[Iterable, AsyncIterable],
+        worker: Callable[..., Awaitable],
+        concurrency: int,
+        interval: float = 0.0,
+        logger: logging.Logger = logging.getLogger(__name__),
+        item_name: Callable = repr) -> list:
+    """Runs the worker for every item keeping up to `concurrency` of them in flight at all times
+
+    A new item starts as soon as any running one finishes, instead of waiting for a
+    whole batch. Errors are logged and the item is skipped, so one failure does not
+    discard the results of the others.
+
+    Args:
+        items (Union[Iterable, AsyncIterable]): items to be processed, async iterables are consumed as they produce
+        worker (Callable[..., Awaitable]): coroutine function called with each item
+        concurrency (int): maximum number of items processed at the same time
+        interval (float): minimum interval in seconds between the start of two items
+        logger (logging.Logger): logger for the errors
+        item_name (Callable): function to describe the item on the error messages
+
+    Returns:
+        returns a list with the results of the items that finished without errors, in the order they finished
+    """
+    concurrency = max(concurrency, 1)
+    queue = asyncio.Queue(maxsize=concurrency)
+    pacer = Pacer(interval)
+    results = []
+
+    async def produce():
+        try:
+            async for item in iterate_items(items):
+                await queue.put(item)
+        finally:
+            for _ in range(concurrency):
+                await queue.put(_DONE)
+
+    async def consume():
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                return
+
+            await pacer.wait()
+            try:
+                results.append(await worker(item))
+            except Exception:
+                logger.error(f'error processing {item_name(item)}: {traceback.format_exc()}')
+
+    producer = asyncio.create_task(produce())
+    try:
+        await asyncio.gather(*[consume() for _ in range(concurrency)])
+    finally:
+        if not producer.done():
+            producer.cancel()
+    # raises the errors of the items source, if any
+    await producer
+    return results
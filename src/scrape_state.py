@@ -0,0 +1,93 @@
+"""Module to keep the state of the scrape between the runs of the service"""
+import hashlib
+import json
+import time
+from dataclasses import dataclass
+from typing import Iterable, Union
+
+
+def fingerprint(data: dict, ignored_fields: Iterable = ()) -> str:
+    """Creates a hash of the dictionary, used to detect changes on the information of a ticker
+
+    Args:
+        data (dict): information to be hashed
+        ignored_fields (Iterable): keys that are not considered
+
+    Returns:
+        returns the hash as a hexadecimal string
+    """
+    ignored_fields = set(ignored_fields)
+    content = {key: value for key, value in data.items() if key not in ignored_fields}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+@dataclass
+class TickerPage:
+    """Page information of a ticker and the search information it was collected with"""
+    search_fingerprint: str
+    results: dict
+    results_fingerprint: str
+    fetched_at: float
+
+
+class ScrapeState:
+    """Pages collected on the previous runs, used to fetch only the tickers that changed"""
+
+    def __init__(self, max_age_seconds: float, ignored_fields: Iterable = ()) -> None:
+        self.max_age_seconds = max_age_seconds
+        self.ignored_fields = list(ignored_fields)
+        self.pages = {}
+        self.changed_pages = 0
+
+    def start_run(self):
+        self.changed_pages = 0
+
+    def needs_fetch(self, ticker_general: dict) -> bool:
+        """Checks if the page of the ticker changed on the search or is older than max_age_seconds
+
+        Args:
+            ticker_general (dict): ticker information returned by the status invest search
+
+        Returns:
+            returns True if the page needs to be fetched
+        """
+        page = self.pages.get(ticker_general.get('ticker'))
+        return (page is None
+                or time.time() - page.fetched_at >= self.max_age_seconds
+                or page.search_fingerprint != fingerprint(ticker_general, self.ignored_fields))
+
+    def store(self, ticker_general: dict, results: dict) -> bool:
+        """Stores the page information collected for the ticker
+
+        Args:
+            ticker_general (dict): ticker information returned by the status invest search
+            results (dict): information collected on the ticker page
+
+        Returns:
+            returns True if the page information changed since the previous run
+        """
+        symbol = ticker_general.get('ticker')
+        results_fingerprint = fingerprint(results)
+        previous = self.pages.get(symbol)
+        changed = previous is None or previous.results_fingerprint != results_fingerprint
+        if changed:
+            self.changed_pages += 1
+
+        self.pages[symbol] = TickerPage(
+            search_fingerprint=fingerprint(ticker_general, self.ignored_fields),
+            results=results,
+            results_fingerprint=results_fingerprint,
+            fetched_at=time.time(),
+        )
+        return changed
+
+    def get_results(self, symbol: str) -> Union[None, dict]:
+        page = self.pages.get(symbol)
+        return page.results if page else None
+
+    def prune(self, symbols: Iterable):
+        """Removes the tickers that are not on the search anymore"""
+        symbols = set(symbols)
+        for symbol in list(self.pages):
+            if symbol not in symbols:
+                del self.pages[symbol]
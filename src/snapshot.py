@@ -0,0 +1,439 @@
+"""Module with the format of the stocks information published by the service and the in-memory copy kept by the api
+
+The information is published as a columnar snapshot, each column is a typed numpy
+array written one after the other, preceded by a header with the schema. Reading
+a snapshot does not copy the columns, the arrays are views over the redis value.
+
+Every publication is written on a key of its own version and a pointer key is swapped
+to it on the same transaction, the last main_data_keep_versions versions are kept so
+the api can also answer with the information of a past publication.
+
+While a run is in progress the service also writes each ticker as soon as it is
+processed on a redis hash, the api can use it over the last published snapshot.
+"""
+import asyncio
+import json
+import logging
+import traceback
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Union
+
+import numpy as np
+import orjson
+
+from config import logger
+from config import settings
+from databases import postgres, redis
+
+
+SNAPSHOT_SCHEMA = (
+    ('symbol', '<U12'),
+    ('roic', '<f8'),
+    ('vpa', '<f8'),
+    ('lpa', '<f8'),
+    ('p_l', '<f8'),
+    ('p_vp', '<f8'),
+    ('dividend_yield', '<f8'),
+    ('current_price', '<f8'),
+    ('earning_yield', '<f8'),
+    ('graham_vi', '<f8'),
+    ('graham_upside', '<f8'),
+    ('ebit', '<f8'),
+    ('market_cap', '<f8'),
+)
+"""name and numpy type of each column of the snapshot, in the order they are returned"""
+
+SNAPSHOT_COLUMNS = [name for name, _ in SNAPSHOT_SCHEMA]
+
+SNAPSHOT_TABLE = 'stock_snapshot'
+SNAPSHOT_TABLE_DDL = (
+    f'CREATE TABLE IF NOT EXISTS {SNAPSHOT_TABLE} ('
+    ' version bigint NOT NULL,'
+    ' published_at timestamptz NOT NULL DEFAULT now(),'
+    ' symbol varchar(12) NOT NULL,'
+    + ''.join(f' {name} double precision,' for name, dtype in SNAPSHOT_SCHEMA if name != 'symbol')
+    + ' PRIMARY KEY (version, symbol))'
+)
+"""table where the published snapshots are kept when persist_snapshot_postgres is enabled"""
+
+SNAPSHOT_MAGIC = b'MFS1'
+_HEADER_SIZE = struct.Struct('<I')
+_ALIGNMENT = 8
+
+
+def _padding(size: int) -> int:
+    return -size % _ALIGNMENT
+
+
+def _to_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def build_columns(records: list) -> dict:
+    """Converts the records processed by the service into the snapshot columns
+
+    Args:
+        records (list): list of dicts with the fields of SNAPSHOT_SCHEMA
+
+    Returns:
+        returns a dict with a numpy array for each column
+    """
+    columns = {}
+    for name, dtype in SNAPSHOT_SCHEMA:
+        values = [record.get(name) for record in records]
+        if np.dtype(dtype).kind == 'f':
+            values = [_to_float(value) for value in values]
+        columns[name] = np.array(values, dtype=dtype)
+    return columns
+
+
+def empty_snapshot() -> dict:
+    return {name: np.empty(0, dtype=dtype) for name, dtype in SNAPSHOT_SCHEMA}
+
+
+def encode_snapshot(columns: dict) -> bytes:
+    """Serializes the columns into the snapshot format
+
+    Args:
+        columns (dict): dict with a numpy array for each column of SNAPSHOT_SCHEMA
+
+    Returns:
+        returns the bytes to be published
+    """
+    rows = len(columns[SNAPSHOT_COLUMNS[0]])
+    buffers = []
+    header_columns = []
+    offset = 0
+    for name, dtype in SNAPSHOT_SCHEMA:
+        column = np.ascontiguousarray(columns[name], dtype=dtype)
+        if len(column) != rows:
+            raise ValueError(f'column {name} has {len(column)} rows, expected {rows}')
+
+        data = column.tobytes()
+        header_columns.append({'name': name, 'dtype': dtype, 'offset': offset})
+        buffers.append(data + b'\0' * _padding(len(data)))
+        offset += len(data) + _padding(len(data))
+
+    header = json.dumps({'rows': rows, 'columns': header_columns}).encode()
+    header += b' ' * _padding(len(SNAPSHOT_MAGIC) + _HEADER_SIZE.size + len(header))
+    return b''.join([SNAPSHOT_MAGIC, _HEADER_SIZE.pack(len(header)), header, *buffers])
+
+
+def decode_snapshot(blob: bytes) -> dict:
+    """Reads a snapshot without copying the columns
+
+    Args:
+        blob (bytes): value published by the service
+
+    Returns:
+        returns a dict with a read only numpy array for each column
+
+    Raises:
+        ValueError:
+            if the value is not on the snapshot format
+    """
+    if not blob:
+        return empty_snapshot()
+
+    if blob[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError('value is not a stocks information snapshot')
+
+    start = len(SNAPSHOT_MAGIC)
+    header_size, = _HEADER_SIZE.unpack_from(blob, start)
+    start += _HEADER_SIZE.size
+    header = json.loads(blob[start:start + header_size])
+    start += header_size
+
+    rows = header['rows']
+    return {
+        column['name']: np.frombuffer(blob, dtype=column['dtype'], count=rows, offset=start + column['offset'])
+        for column in header['columns']
+    }
+
+
+def merge_records(columns: dict, records: list) -> dict:
+    """Replaces the rows of the columns by the records with the same symbol, appending the new symbols
+
+    Args:
+        columns (dict): dict with a numpy array for each column of SNAPSHOT_SCHEMA
+        records (list): list of dicts with the fields of SNAPSHOT_SCHEMA
+
+    Returns:
+        returns a new dict with the merged columns
+    """
+    if not records:
+        return columns
+
+    updated = build_columns(records)
+    keep = ~np.isin(columns['symbol'], updated['symbol'])
+    return {name: np.concatenate([columns[name][keep], updated[name]]) for name in SNAPSHOT_COLUMNS}
+
+
+async def publish_snapshot(conn_info: redis.RedisConnectionInfo, columns: dict, version: int = None) -> bool:
+    """Publishes the snapshot on the key of its version and swaps the current version on a single transaction
+
+    The versions older than the last main_data_keep_versions, the live tickers of
+    the run, that are all on the snapshot, and the single key used before the
+    versions existed are removed on the same transaction.
+
+    Args:
+        conn_info (redis.RedisConnectionInfo): connection info
+        columns (dict): dict with a numpy array for each column of SNAPSHOT_SCHEMA
+        version (int): version of the snapshot, if not informed the current time in nanoseconds is used
+
+    Returns:
+        returns a boolean with the status of the operation
+    """
+    return await redis.publish_version_on_redis_async(
+        conn_info,
+        settings.main_data_identifier,
+        settings.main_data_version_identifier,
+        settings.main_data_versions_identifier,
+        version if version is not None else time.time_ns(),
+        encode_snapshot(columns),
+        settings.main_data_keep_versions,
+        keys_to_delete=[
+            settings.main_data_identifier, settings.live_tickers_identifier, settings.live_tickers_version_identifier
+        ],
+    )
+
+
+_snapshot_table_created = False
+
+
+async def persist_snapshot(version: int, columns: dict) -> dict:
+    """Writes the snapshot on postgres, with a row for each ticker, on a single batch
+
+    Args:
+        version (int): version of the snapshot
+        columns (dict): dict with a numpy array for each column of SNAPSHOT_SCHEMA
+
+    Returns:
+        returns a dictionary with the status of the operation
+    """
+    global _snapshot_table_created
+    if not _snapshot_table_created:
+        res = await postgres.post_info_into_database(SNAPSHOT_TABLE_DDL)
+        if not res or res.get('error'):
+            return res
+        _snapshot_table_created = True
+
+    query = (
+        f'INSERT INTO {SNAPSHOT_TABLE} (version, {", ".join(SNAPSHOT_COLUMNS)})'
+        f' VALUES (%s, {", ".join(["%s"] * len(SNAPSHOT_COLUMNS))}) ON CONFLICT DO NOTHING'
+    )
+    values = [columns[name].tolist() for name in SNAPSHOT_COLUMNS]
+    return await postgres.post_many_into_database(query, [(version, *row) for row in zip(*values)])
+
+
+class LiveTickerPublisher:
+    """Writes the tickers on the live tickers hash while the run is in progress
+
+    The tickers are grouped and written with a single pipelined round trip, when
+    live_publish_batch_size tickers are waiting or when the oldest has waited for
+    live_publish_interval_seconds, checked by a timer task. close must be called
+    at the end of the run, so the tickers still waiting are written.
+    """
+
+    def __init__(self,
+                 conn_info: redis.RedisConnectionInfo,
+                 identifier: str = settings.live_tickers_identifier,
+                 version_identifier: str = settings.live_tickers_version_identifier,
+                 batch_size: int = settings.live_publish_batch_size,
+                 interval_seconds: float = settings.live_publish_interval_seconds) -> None:
+        self.conn_info = conn_info
+        self.identifier = identifier
+        self.version_identifier = version_identifier
+        self.batch_size = batch_size
+        self.interval_seconds = interval_seconds
+        self._pending = {}
+        self._flush_task = None
+
+    async def add(self, record: dict):
+        """Adds the ticker to be written, writing the pending tickers if needed
+
+        Args:
+            record (dict): dict with the fields of SNAPSHOT_SCHEMA
+        """
+        self._pending[record['symbol']] = orjson.dumps(record, option=orjson.OPT_SERIALIZE_NUMPY)
+        if len(self._pending) >= self.batch_size or self.interval_seconds <= 0:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval_seconds)
+        # cleared before the flush, so the flush does not cancel the task running it
+        self._flush_task = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.log_message(f'Error writing the live tickers {traceback.format_exc()}', level=logging.ERROR)
+
+    async def flush(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+        pending, self._pending = self._pending, {}
+        if pending:
+            await redis.set_hash_fields_on_redis_async(
+                self.conn_info, self.identifier, pending, counter_key=self.version_identifier
+            )
+
+    async def close(self):
+        """Writes the tickers still waiting, errors are only logged since the run is already over"""
+        try:
+            await self.flush()
+        except Exception:
+            logger.log_message(f'Error writing the live tickers {traceback.format_exc()}', level=logging.ERROR)
+
+
+class SnapshotStore:
+    """Decoded copy of the stocks information kept by each api worker
+
+    The service swaps the version key every time it publishes the information,
+    so the worker only needs to read the version on each request and download
+    the object of a version once, the published versions never change.
+    """
+
+    def __init__(self,
+                 identifier: str = settings.main_data_identifier,
+                 version_identifier: str = settings.main_data_version_identifier,
+                 versions_identifier: str = settings.main_data_versions_identifier,
+                 live_identifier: str = settings.live_tickers_identifier,
+                 live_version_identifier: str = settings.live_tickers_version_identifier,
+                 use_live_data: bool = settings.api_use_live_ticker_data,
+                 versions_in_memory: int = settings.api_snapshot_versions_in_memory) -> None:
+        self.identifier = identifier
+        self.version_identifier = version_identifier
+        self.versions_identifier = versions_identifier
+        self.live_identifier = live_identifier
+        self.live_version_identifier = live_version_identifier
+        self.use_live_data = use_live_data
+        self.versions_in_memory = versions_in_memory
+        # version and data are swapped together so concurrent requests never see a mixed state
+        self._snapshot = (None, None)
+        # published snapshots without the live tickers, so a change on the live tickers does not download them again
+        self._published = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def get_version(self, conn_info: redis.RedisConnectionInfo) -> Union[None, bytes]:
+        """Reads the current version of the stocks information
+
+        When the live tickers are used the version also has the version of the live
+        tickers, separated by a +, so it changes every time the service writes a ticker.
+
+        Args:
+            conn_info (redis.RedisConnectionInfo): connection info
+
+        Returns:
+            returns the published version, None if the service did not publish a version
+        """
+        if not self.use_live_data:
+            return await redis.get_value_from_redis_async(conn_info, self.version_identifier)
+
+        version, live_version = await redis.get_values_from_redis_async(
+            conn_info, [self.version_identifier, self.live_version_identifier]
+        )
+        if live_version is None:
+            return version
+        return (version or b'') + b'+' + live_version
+
+    async def get_version_as_of(self, conn_info: redis.RedisConnectionInfo, as_of: int) -> Union[None, bytes]:
+        """Returns the last version published until as_of
+
+        Args:
+            conn_info (redis.RedisConnectionInfo): connection info
+            as_of (int): time in nanoseconds since the epoch, the same unit of the versions
+
+        Returns:
+            returns the version, None if no version still kept on redis was published until as_of
+        """
+        return await redis.get_last_version_from_redis_async(conn_info, self.versions_identifier, as_of)
+
+    def _get_in_memory(self, version: Union[None, bytes]) -> Union[None, dict]:
+        with self._lock:
+            data = self._published.get(version)
+            if data is not None:
+                self._published.move_to_end(version)
+            return data
+
+    def _set_in_memory(self, version: bytes, data: dict):
+        with self._lock:
+            self._published[version] = data
+            self._published.move_to_end(version)
+            while len(self._published) > max(self.versions_in_memory, 1):
+                self._published.popitem(last=False)
+
+    async def get_published_data(
+            self, conn_info: redis.RedisConnectionInfo, version: Union[None, bytes]) -> Union[None, dict]:
+        """Returns the published snapshot for the version, only going to redis if it is not in memory
+
+        Args:
+            conn_info (redis.RedisConnectionInfo): connection info
+            version (Union[None, bytes]): published version, None if the service did not publish a version
+
+        Returns:
+            returns a dict with the columns of the snapshot, empty when there is no version,
+            None if the version is no longer on redis or is invalid
+        """
+        if version is None:
+            return empty_snapshot()
+
+        data = self._get_in_memory(version)
+        if data is not None:
+            return data
+
+        key = f'{self.identifier}:{version.decode()}'
+        blob = await redis.get_value_from_redis_async(conn_info, key)
+        if blob is None:
+            # the version was evicted after it was read, it is never replaced by other information
+            logger.log_message(f'Snapshot of version {version} not found on key {key}', level=logging.WARNING)
+            return None
+
+        try:
+            data = decode_snapshot(blob)
+        except ValueError:
+            logger.log_message(f'Invalid snapshot found on key {key}', level=logging.WARNING)
+            return None
+
+        self._set_in_memory(version, data)
+        return data
+
+    async def get_live_records(self, conn_info: redis.RedisConnectionInfo) -> list:
+        """Returns the tickers already processed by the run in progress"""
+        fields = await redis.get_hash_from_redis_async(conn_info, self.live_identifier)
+        return [orjson.loads(value) for value in fields.values()]
+
+    async def get_data(self, conn_info: redis.RedisConnectionInfo, version: Union[None, bytes]) -> dict:
+        """Returns the stocks information for the version, only going to redis if it is not in memory
+
+        Args:
+            conn_info (redis.RedisConnectionInfo): connection info
+            version (Union[None, bytes]): version returned by get_version or get_version_as_of
+
+        Returns:
+            returns a dict with the columns of the stocks information published by the service,
+            None if the published version is no longer available
+        """
+        if version is None or b'+' not in version:
+            return await self.get_published_data(conn_info, version)
+
+        current_version, data = self._snapshot
+        if version == current_version:
+            return data
+
+        published_version, _, live_version = version.partition(b'+')
+        data = await self.get_published_data(conn_info, published_version or None)
+        if data is None:
+            return None
+        data = merge_records(data, await self.get_live_records(conn_info))
+        self._snapshot = (version, data)
+        return data
@@ -1,21 +1,47 @@
 import httpx
 import asyncio
+import contextlib
+import hashlib
 import logging
+import math
+import multiprocessing
 import traceback
 
 from bs4 import BeautifulSoup
 import re
-import lxml
+from lxml import etree
 from pprint import pprint
 import os
-import pickle
+import json
 import datetime
-import aiofiles
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import AsyncIterator, Union
+import numpy as np
+from config import settings
 from config.settings import use_cache, file_ttl_minutes
+from cache_store import CacheStore
+from http_cache import ConditionalCache, get_stored_headers
+from rate_limiter import AdaptiveRateLimiter, request_with_retry
 
 
 file_ttl = datetime.timedelta(minutes=file_ttl_minutes)
 
+page_cache = ConditionalCache(settings.http_cache_max_entries)
+"""pages with ETag or Last-Modified, revalidated with conditional requests"""
+
+rate_limiter = AdaptiveRateLimiter(
+    rate=settings.rate_limit_requests_per_second,
+    min_rate=settings.rate_limit_min_requests_per_second,
+    max_rate=settings.rate_limit_max_requests_per_second,
+    burst=settings.rate_limit_burst,
+    target_latency=settings.rate_limit_target_latency_seconds,
+)
+"""rate limiter shared by all the requests to status invest"""
+
+module_logger = logging.getLogger(__name__)
+
 INDEXES_URLS = {
     "BRX100": "https://statusinvest.com.br/indices/indice-brasil-100",
     "SMALL": "https://statusinvest.com.br/indices/indice-small-cap",
@@ -30,31 +56,116 @@ INDEXES_URLS = {
 }
 
 
+DEFAULT_HEADERS = {
+    'accept': '*/*',
+    'accept-language': 'en-US,en;q=0.9,pt-BR;q=0.8,pt;q=0.7,es-MX;q=0.6,es;q=0.5',
+    'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
+    'x-requested-with': 'XMLHttpRequest',
+    'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko)'
+}
+"""headers sent on every request to status invest"""
+
+BROWSER_HEADERS = {
+    'sec-ch-ua': '" Not;A Brand";v="99", "Google Chrome";v="97", "Chromium";v="97"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"macOS"',
+    'sec-fetch-dest': 'empty',
+    'sec-fetch-mode': 'cors',
+    'sec-fetch-site': 'same-origin',
+}
+"""extra headers sent on the requests that mimic the browser search pages"""
+
+
+def create_client() -> httpx.AsyncClient:
+    """Creates the client used for the requests to status invest, it should be reused for the whole scrape
+    so the connections are kept alive between the requests
+
+    :return: client with the connection pool limits and default headers
+    :rtype: httpx.AsyncClient
+    """
+    limits = httpx.Limits(
+        max_connections=settings.http_max_connections,
+        max_keepalive_connections=settings.http_max_keepalive_connections,
+        keepalive_expiry=settings.http_keepalive_expiry_seconds,
+    )
+    return httpx.AsyncClient(
+        verify=False,
+        follow_redirects=True,
+        http2=settings.http2_enabled,
+        limits=limits,
+        headers=DEFAULT_HEADERS,
+        timeout=settings.http_timeout_seconds,
+    )
+
+
+@contextlib.asynccontextmanager
+async def get_client(client: httpx.AsyncClient = None):
+    """Uses the informed client or creates one that is closed at the end of the block"""
+    if client is not None:
+        yield client
+        return
+
+    async with create_client() as new_client:
+        yield new_client
+
+
+async def send_request(client: httpx.AsyncClient, method: str, url: str, **kwargs) -> httpx.Response:
+    """Sends a request to status invest using the shared rate limiter and retry policy
+
+    :param client: client used for the request
+    :type client: httpx.AsyncClient
+    :return: response of the last attempt
+    :rtype: httpx.Response
+    """
+    return await request_with_retry(
+        client, method, url, rate_limiter,
+        max_retries=settings.http_max_retries,
+        backoff_base=settings.http_backoff_base_seconds,
+        backoff_max=settings.http_backoff_max_seconds,
+        logger=module_logger,
+        **kwargs
+    )
+
+
 async def filter_stocks(
-        stocks_info: list,
+        stocks_info: dict,
         indexes: list = ['NONE'],
         list_tickers: list = [],
         min_ebit: int = 1,
         min_market_cap: int = 0,
-        logger: logging.Logger = logging.getLogger(__name__)) -> list:
+        logger: logging.Logger = logging.getLogger(__name__),
+        index_members: dict = None) -> dict:
+    """Filters the columns of the stocks information
+
+    :param stocks_info: dict with a numpy array for each column of the snapshot
+    :type stocks_info: dict
+    :param index_members: tickers of each index published by the service, indexes not found are considered empty
+    :type index_members: dict
+    :return: dict with the columns containing only the selected stocks
+    :rtype: dict
+    """
     # filter stocks by indexes
-    tickers = await get_stocks_by_index(indexes, list_tickers, logger)
-    if indexes == ['NONE']:
+    tickers = await get_stocks_by_index(indexes, list_tickers, logger, index_members)
+    if indexes == ['NONE'] and not list_tickers:
         return stocks_info
 
     # filter stocks by ebit and market cap
-    stocks_info = [stock for stock in stocks_info if stock[11] >= min_ebit and stock[12] >= min_market_cap]
+    mask = (stocks_info['ebit'] >= min_ebit) & (stocks_info['market_cap'] >= min_market_cap)
+    mask &= np.isin(stocks_info['symbol'], list(tickers))
 
-    return [stock for stock in stocks_info if stock[0] in tickers]
+    return {name: column[mask] for name, column in stocks_info.items()}
 
 
 async def get_stocks_by_index(
         indexes: list = ['NONE'], list_tickers: list = [], 
-        logger: logging.Logger = logging.getLogger(__name__)) -> set:
+        logger: logging.Logger = logging.getLogger(__name__),
+        index_members: dict = None) -> set:
     """Get list of tickers and indexes
 
     :param logger: Logger
     :type logger: logging.Logger
+    :param index_members: tickers of each index published by the service, indexes not found are considered empty
+    :type index_members: dict
     :return: Tuple with tickers and indexes
     :rtype: tuple
     """
@@ -66,45 +177,86 @@ async def get_stocks_by_index(
     if indexes == ['NONE', ] or not indexes:
         return set()
 
-    stock_tickers = set()
     if indexes == ['ALL', ]:
-        for index in INDEXES_URLS:
-            stock_tickers.update(await get_index_info(INDEXES_URLS[index], logger))
-        return stock_tickers
+        indexes = list(INDEXES_URLS)
 
+    index_members = index_members or {}
+    stock_tickers = set()
     for index in indexes:
-        stock_tickers.update(await get_index_info(INDEXES_URLS[index], logger))
+        if index not in index_members:
+            # the indexes are only collected by the service, never while answering a request
+            logger.warning(f'Index {index} not found on cache, considered empty')
+            continue
+
+        stock_tickers.update(index_members[index])
     return stock_tickers
 
 
-async def get_index_info(url: str, logger: logging.Logger) -> set:
+def get_missing_indexes(indexes: list, list_tickers: list, index_members: dict) -> list:
+    """Returns the indexes requested that were not published by the service yet
+
+    ALL uses the indexes already published, it is only missing when none of them was published.
+
+    :param indexes: indexes requested
+    :type indexes: list
+    :param list_tickers: tickers requested, when informed the indexes are not used
+    :type list_tickers: list
+    :param index_members: tickers of each index published by the service
+    :type index_members: dict
+    :return: list with the indexes not found
+    :rtype: list
+    """
+    if list_tickers:
+        return []
+
+    index_members = index_members or {}
+    if indexes == ['ALL', ]:
+        # an index page failing on the service must not make the other indexes unavailable
+        return [] if any(index in index_members for index in INDEXES_URLS) else list(INDEXES_URLS)
+    return [index for index in indexes if index in INDEXES_URLS and index not in index_members]
+
+
+async def get_all_indexes_info(logger: logging.Logger, client: httpx.AsyncClient = None) -> dict:
+    """Returns the tickers of all the indexes, fetching the pages concurrently
+
+    :param logger: Logger object
+    :type logger: logging.Logger
+    :param client: client created by create_client, if not informed a new one is created for each request
+    :type client: httpx.AsyncClient
+    :return: dict with a set of tickers for each index, indexes that failed are not returned
+    :rtype: dict
+    """
+    results = await asyncio.gather(
+        *[get_index_info(url, logger, client) for url in INDEXES_URLS.values()],
+        return_exceptions=True
+    )
+
+    index_members = {}
+    for index, result in zip(INDEXES_URLS, results):
+        if isinstance(result, Exception):
+            logger.error(f'error collecting tickers for index {index}: {result!r}')
+            continue
+        index_members[index] = result
+    return index_members
+
+
+async def get_index_info(url: str, logger: logging.Logger, client: httpx.AsyncClient = None) -> set:
     """Returns set with index tickers
 
     :param url: status invest url
     :type url: str
     :param logger: Logger object
     :type logger: logging.Logger
+    :param client: client created by create_client, if not informed a new one is created for the request
+    :type client: httpx.AsyncClient
     :return: set with index tickers
     :rtype: set
     """
     logger.info(f'Processing url: {url}')
 
-    headers = {
-        'accept': '*/*',
-        'accept-language': 'en-US,en;q=0.9,pt-BR;q=0.8,pt;q=0.7,es-MX;q=0.6,es;q=0.5',
-        'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
-        'x-requested-with': 'XMLHttpRequest',
-        'sec-ch-ua': '" Not;A Brand";v="99", "Google Chrome";v="97", "Chromium";v="97"',
-        'sec-ch-ua-mobile': '?0',
-        'sec-ch-ua-platform': '"macOS"',
-        'sec-fetch-dest': 'empty',
-        'sec-fetch-mode': 'cors',
-        'sec-fetch-site': 'same-origin',
-        'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko)'
-    }
-
-    async with httpx.AsyncClient(verify=False, follow_redirects=True) as client:
-        resp = await client.get(url, headers=headers)
+    async with get_client(client) as client:
+        resp = await send_request(client, 'GET', url, headers=BROWSER_HEADERS)
+    resp.raise_for_status()
 
     request_content = resp.content
     beatiful_soup = BeautifulSoup(request_content, "html.parser")
@@ -116,177 +268,408 @@ async def get_index_info(url: str, logger: logging.Logger) -> set:
     return tickers
 
 
-async def get_stocks_info():
-    resp = await get_cached_info('get_stocks_info')
-    if resp:
-        return resp
-
-    url = 'https://statusinvest.com.br/category/advancedsearchresultpaginated?search=%7B%22Sector%22%3A%22%22%2C%22SubSector%22%3A%22%22%2C%22Segment%22%3A%22%22%2C%22my_range%22%3A%22-20%3B100%22%2C%22forecast%22%3A%7B%22upsidedownside%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22estimatesnumber%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22revisedup%22%3Atrue%2C%22reviseddown%22%3Atrue%2C%22consensus%22%3A%5B%5D%7D%2C%22dy%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22p_l%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22peg_ratio%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22p_vp%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22p_ativo%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22margembruta%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22margemebit%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22margemliquida%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22p_ebit%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22ev_ebit%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22dividaliquidaebit%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22dividaliquidapatrimonioliquido%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22p_sr%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22p_capitalgiro%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22p_ativocirculante%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22roe%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22roic%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22roa%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22liquidezcorrente%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22pl_ativo%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22passivo_ativo%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22giroativos%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22receitas_cagr5%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22lucros_cagr5%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22liquidezmediadiaria%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22vpa%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22lpa%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%2C%22valormercado%22%3A%7B%22Item1%22%3Anull%2C%22Item2%22%3Anull%7D%7D&orderColumn=&isAsc=&page=0&take=621&CategoryType=1'
-    headers = {
-        'accept': '*/*',
-        'accept-language': 'en-US,en;q=0.9,pt-BR;q=0.8,pt;q=0.7,es-MX;q=0.6,es;q=0.5',
-        'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
-        'x-requested-with': 'XMLHttpRequest',
-        'sec-ch-ua': '" Not;A Brand";v="99", "Google Chrome";v="97", "Chromium";v="97"',
-        'sec-ch-ua-mobile': '?0',
-        'sec-ch-ua-platform': '"macOS"',
-        'sec-fetch-dest': 'empty',
-        'sec-fetch-mode': 'cors',
-        'sec-fetch-site': 'same-origin',
-        'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko)'
-    }
-    async with httpx.AsyncClient(verify=False, follow_redirects=True) as client:
-        resp = await client.get(url, headers=headers)
+SEARCH_URL = 'https://statusinvest.com.br/category/advancedsearchresultpaginated'
 
-    await save_cached_info('get_stocks_info', resp)
-    return resp
+SEARCH_RANGE_FIELDS = [
+    'dy', 'p_l', 'peg_ratio', 'p_vp', 'p_ativo', 'margembruta', 'margemebit', 'margemliquida', 'p_ebit',
+    'ev_ebit', 'dividaliquidaebit', 'dividaliquidapatrimonioliquido', 'p_sr', 'p_capitalgiro',
+    'p_ativocirculante', 'roe', 'roic', 'roa', 'liquidezcorrente', 'pl_ativo', 'passivo_ativo', 'giroativos',
+    'receitas_cagr5', 'lucros_cagr5', 'liquidezmediadiaria', 'vpa', 'lpa', 'valormercado',
+]
+"""indicators that can be filtered by a range on the advanced search"""
 
 
-async def get_stocks_historical_info(ticker: str):
+def create_search(**filters) -> dict:
+    """Creates the search object of the advanced search, without filters it returns every stock
+
+    :param filters: fields of the search to be changed, the ranges are informed as a (minimum, maximum) tuple,
+        e.g. create_search(Sector='1', roic=(0, None))
+    :return: dict with the search, sent as json on the search parameter
+    :rtype: dict
+    """
+    search = {
+        'Sector': '',
+        'SubSector': '',
+        'Segment': '',
+        'my_range': '-20;100',
+        'forecast': {
+            'upsidedownside': {'Item1': None, 'Item2': None},
+            'estimatesnumber': {'Item1': None, 'Item2': None},
+            'revisedup': True,
+            'reviseddown': True,
+            'consensus': [],
+        },
+        **{field: {'Item1': None, 'Item2': None} for field in SEARCH_RANGE_FIELDS},
+    }
+    for field, value in filters.items():
+        if field in SEARCH_RANGE_FIELDS:
+            value = {'Item1': value[0], 'Item2': value[1]}
+        search[field] = value
+    return search
+
+
+def get_search_url(search: dict, page: int, take: int) -> str:
+    """Creates the url of a page of the advanced search
+
+    :param search: search object created by create_search
+    :type search: dict
+    :param page: page number, starting on 0
+    :type page: int
+    :param take: number of stocks on each page
+    :type take: int
+    :return: url of the page
+    :rtype: str
+    """
+    params = {
+        'search': json.dumps(search, separators=(',', ':')),
+        'orderColumn': '',
+        'isAsc': '',
+        'page': page,
+        'take': take,
+        'CategoryType': 1,
+    }
+    return f'{SEARCH_URL}?{urllib.parse.urlencode(params)}'
+
+
+async def get_stocks_search_page(search: dict, page: int, take: int, client: httpx.AsyncClient = None) -> dict:
+    """Requests a page of the advanced search
+
+    :param search: search object created by create_search
+    :type search: dict
+    :param page: page number, starting on 0
+    :type page: int
+    :param take: number of stocks on each page
+    :type take: int
+    :param client: client created by create_client, if not informed a new one is created for the request
+    :type client: httpx.AsyncClient
+    :return: dict with the totalResults of the search and the list of stocks of the page
+    :rtype: dict
+    """
+    url = get_search_url(search, page, take)
+    identifier = f'get_stocks_info_{hashlib.sha1(url.encode()).hexdigest()}'
+    resp = await get_cached_info(identifier)
+    if not resp:
+        async with get_client(client) as client:
+            resp = await send_request(client, 'GET', url, headers=BROWSER_HEADERS)
+        resp.raise_for_status()
+        await save_cached_info(identifier, resp)
+
+    return resp.json()
+
+
+async def iter_stocks_info(
+        client: httpx.AsyncClient = None,
+        search: dict = None,
+        page_size: int = settings.search_page_size,
+        parallel_pages: int = settings.search_parallel_pages) -> AsyncIterator[dict]:
+    """Yields the stocks of the advanced search as the pages arrive
+
+    The first page informs the total of stocks, the remaining pages are requested
+    concurrently, so the processing of the stocks can start before the whole
+    search is downloaded.
+
+    :param client: client created by create_client, if not informed a new one is created for the requests
+    :type client: httpx.AsyncClient
+    :param search: search object created by create_search, if not informed every stock is returned
+    :type search: dict
+    :param page_size: number of stocks on each page
+    :type page_size: int
+    :param parallel_pages: maximum number of pages requested at the same time
+    :type parallel_pages: int
+    :return: async iterator with the information of each stock
+    :rtype: AsyncIterator[dict]
+    """
+    search = search if search is not None else create_search(**settings.stocks_search_filters)
+    async with get_client(client) as client:
+        first_page = await get_stocks_search_page(search, 0, page_size, client)
+        total = first_page.get('totalResults') or 0
+        seen = set()
+
+        def new_stocks(page_result: dict) -> list:
+            stocks = []
+            for stock in page_result.get('list') or []:
+                # the pages may overlap if the search changes between the requests
+                if stock.get('ticker') not in seen:
+                    seen.add(stock.get('ticker'))
+                    stocks.append(stock)
+            return stocks
+
+        for stock in new_stocks(first_page):
+            yield stock
+
+        semaphore = asyncio.Semaphore(max(parallel_pages, 1))
+
+        async def get_page(page: int) -> dict:
+            async with semaphore:
+                return await get_stocks_search_page(search, page, page_size, client)
+
+        pages = [asyncio.create_task(get_page(page)) for page in range(1, math.ceil(total / page_size))]
+        try:
+            for next_page in asyncio.as_completed(pages):
+                for stock in new_stocks(await next_page):
+                    yield stock
+        finally:
+            for page in pages:
+                page.cancel()
+
+    module_logger.info(f'Returned {len(seen)} stocks of {total} on the search')
+
+
+async def get_stocks_info(client: httpx.AsyncClient = None, search: dict = None) -> list:
+    """Returns every stock of the advanced search
+
+    :param client: client created by create_client, if not informed a new one is created for the requests
+    :type client: httpx.AsyncClient
+    :param search: search object created by create_search, if not informed every stock is returned
+    :type search: dict
+    :return: list with the information of each stock
+    :rtype: list
+    """
+    return [stock async for stock in iter_stocks_info(client, search)]
+
+
+async def get_stocks_historical_info(ticker: str, client: httpx.AsyncClient = None):
     resp = await get_cached_info(f'get_stocks_historical_info_{ticker}')
     if resp:
         return ticker, resp
 
     url = 'https://statusinvest.com.br/acao/indicatorhistorical'
-    headers = {
-        'accept': '*/*',
-        'accept-language': 'en-US,en;q=0.9,pt-BR;q=0.8,pt;q=0.7,es-MX;q=0.6,es;q=0.5',
-        'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
-        'x-requested-with': 'XMLHttpRequest',
-        'sec-ch-ua': '" Not;A Brand";v="99", "Google Chrome";v="97", "Chromium";v="97"',
-        'sec-ch-ua-mobile': '?0',
-        'sec-ch-ua-platform': '"macOS"',
-        'sec-fetch-dest': 'empty',
-        'sec-fetch-mode': 'cors',
-        'sec-fetch-site': 'same-origin',
-        'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko)'
-    }
     args = f'ticker={ticker}&time=5'
-    async with httpx.AsyncClient(verify=False, follow_redirects=True) as client:
-        resp = await client.post(f"{url}?{args}", headers=headers)
+    async with get_client(client) as client:
+        resp = await send_request(client, 'POST', f"{url}?{args}", headers=BROWSER_HEADERS)
+    resp.raise_for_status()
     await save_cached_info(f'get_stocks_historical_info_{ticker}', resp)
     return ticker, resp
 
 
-async def get_stocks_historical_price(ticker: str):
+async def get_stocks_historical_price(ticker: str, client: httpx.AsyncClient = None):
     resp = await get_cached_info(f'get_stocks_historical_price_{ticker}')
     if resp:
         return ticker, resp
 
     url = 'https://statusinvest.com.br/acao/tickerprice'
-    headers = {
-        'accept': '*/*',
-        'accept-language': 'en-US,en;q=0.9,pt-BR;q=0.8,pt;q=0.7,es-MX;q=0.6,es;q=0.5',
-        'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
-        'x-requested-with': 'XMLHttpRequest',
-        'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko)'
-    }
     args = f'ticker={ticker}&type=4&currences%5B%5D=1'
-    async with httpx.AsyncClient(verify=False, follow_redirects=True) as client:
-        resp = await client.post(f"{url}?{args}", headers=headers)
+    async with get_client(client) as client:
+        resp = await send_request(client, 'POST', f"{url}?{args}")
+    resp.raise_for_status()
 
     await save_cached_info(f'get_stocks_historical_price_{ticker}', resp)
     return ticker, resp
 
 
-async def get_stocks_page_info(ticker):
-    # resp = await get_cached_info(f'get_stocks_page_info_{ticker}')
-    # if resp:
-    #    # return ticker, resp
-    url = f'https://statusinvest.com.br/acoes/{ticker}'
-    headers = {
-        'accept': '*/*',
-        'accept-language': 'en-US,en;q=0.9,pt-BR;q=0.8,pt;q=0.7,es-MX;q=0.6,es;q=0.5',
-        'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
-        'x-requested-with': 'XMLHttpRequest',
-        'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko)'
-    }
-    async with httpx.AsyncClient(verify=False, follow_redirects=True) as client:
-        resp = await client.get(url, headers=headers)
+async def get_conditional(url: str, client: httpx.AsyncClient = None) -> tuple:
+    """Requests the url revalidating the response stored on page_cache
+
+    :param url: url to be requested
+    :type url: str
+    :param client: client created by create_client, if not informed a new one is created for the request
+    :type client: httpx.AsyncClient
+    :return: tuple with the response, the cache entry of the url and a flag saying if the server answered 304
+    :rtype: tuple
+    """
+    entry = page_cache.get(url)
+    async with get_client(client) as client:
+        resp = await send_request(client, 'GET', url, headers=page_cache.conditional_headers(entry))
+
+    if resp.status_code == 304 and entry is not None:
+        return entry.to_response(resp.request), entry, True
+
+    return resp, page_cache.store(url, resp), False
+
 
-    # await save_cached_info(f'get_stocks_page_info_{ticker}', resp)
+async def get_stocks_page_info(ticker, client: httpx.AsyncClient = None):
+    url = f'https://statusinvest.com.br/acoes/{ticker}'
+    resp, _, _ = await get_conditional(url, client)
     return ticker, resp
 
 
-async def save_cached_info(identifier, obj):
+async def get_stock_page_results(ticker: str, client: httpx.AsyncClient = None,
+                                 logger: logging.Logger = logging.getLogger(__name__)) -> Union[None, dict]:
+    """Returns the information of the ticker page, reusing the parsed result when the page did not change
+
+    :param ticker: ticker symbol
+    :type ticker: str
+    :param client: client created by create_client, if not informed a new one is created for the request
+    :type client: httpx.AsyncClient
+    :return: dict with the information found on the page, None if the page could not be parsed
+    :rtype: Union[None, dict]
+    """
+    url = f'https://statusinvest.com.br/acoes/{ticker}'
+    resp, entry, not_modified = await get_conditional(url, client)
+    resp.raise_for_status()
+    if not_modified and entry.parsed is not None:
+        logger.info(f'Page of {ticker} not modified')
+        return entry.parsed
+
+    results = await format_stock_page(resp.content, logger)
+    if entry is not None and results is not None:
+        entry.parsed = results
+    return results
+
+
+_cache_store = None
+
+
+def get_cache_store() -> CacheStore:
+    """Returns the local cache store, creating it if does not exists"""
+    global _cache_store
+    if _cache_store is None:
+        os.makedirs(os.path.dirname(settings.cache_path) or '.', exist_ok=True)
+        _cache_store = CacheStore(
+            settings.cache_path,
+            max_size_bytes=settings.cache_max_size_mb * 1024 * 1024,
+            default_ttl_seconds=file_ttl.total_seconds(),
+        )
+    return _cache_store
+
+
+def serialize_response(response: httpx.Response) -> bytes:
+    """Serializes only what is needed to rebuild the response, status, headers and content"""
+    metadata = json.dumps({
+        'status_code': response.status_code,
+        'headers': get_stored_headers(response),
+        'method': response.request.method,
+        'url': str(response.request.url),
+    }).encode()
+    return len(metadata).to_bytes(4, 'little') + metadata + response.content
+
+
+def deserialize_response(value: bytes) -> httpx.Response:
+    size = int.from_bytes(value[:4], 'little')
+    metadata = json.loads(value[4:4 + size])
+    return httpx.Response(
+        metadata['status_code'],
+        headers=metadata['headers'],
+        content=value[4 + size:],
+        request=httpx.Request(metadata['method'], metadata['url']),
+    )
+
+
+async def save_cached_info(identifier: str, obj: httpx.Response):
     if not use_cache:
         return
 
-    if not os.path.exists('cache'):
-        os.makedirs('cache')
-
-    async with aiofiles.open(f"cache/{identifier}.cache", 'wb') as f:
-        pickled_foo = pickle.dumps(obj)
-        await f.write(pickled_foo)
+    await asyncio.to_thread(get_cache_store().set, identifier, serialize_response(obj))
 
 
-async def get_cached_info(identifier: str):
+async def get_cached_info(identifier: str) -> Union[None, httpx.Response]:
     if not use_cache:
         return None
 
-    if not os.path.exists('cache'):
-        os.makedirs('cache')
-
-    file_name = f"cache/{identifier}.cache"
-    if not os.path.exists(file_name):
+    value = await asyncio.to_thread(get_cache_store().get, identifier)
+    if value is None:
         return None
 
-    if (datetime.datetime.now() - datetime.datetime.fromtimestamp(os.path.getctime(file_name))).min > file_ttl:
-        os.remove(file_name)
-        return None
+    return deserialize_response(value)
+
+
+_COMPANY_INFO_XPATH = etree.XPath('//div[@id="company-section"]//div[@class="info"]')
+_COMPANY_INFO_CHILDREN_XPATH = etree.XPath(
+    './div//div//strong|./div//div//h3|./div//div//span[@class="d-inline-block mr-2"]'
+)
+_SECTOR_INFO_XPATH = etree.XPath(
+    '//div[@id="company-section"]//div[@class="top-info top-info-1 top-info-sm-2 top-info-md-n sm d-flex justify-between"]'
+    '//div[contains(@class, "info")]'
+)
+_SECTOR_INFO_CHILDREN_XPATH = etree.XPath('./div//div//strong|./div//div//span')
+_NUMBER_REGEX = re.compile(r"^[-\d\,%\.]*$")
+_LEGEND_CLASS = 'title m-0 legend-tooltip'
+# the pages do not always declare the charset, without it lxml decodes the bytes as latin-1
+_HTML_PARSER = etree.HTMLParser(encoding='utf-8')
+
+_parser_pool = None
 
-    async with aiofiles.open(file_name, 'rb') as f:
-        pickled_foo = await f.read()
 
-    return pickle.loads(pickled_foo)
+def get_parser_pool() -> ProcessPoolExecutor:
+    """Returns the process pool used to parse the pages, creating it if does not exists"""
+    global _parser_pool
+    if _parser_pool is None:
+        # the workers are not forked from the service, that already has the background loop and other threads running
+        _parser_pool = ProcessPoolExecutor(
+            max_workers=settings.parser_workers or os.cpu_count(),
+            mp_context=multiprocessing.get_context('forkserver'),
+        )
+    return _parser_pool
 
 
-async def format_stock_page(page_content: bytes, logger = logging.Logger(__name__)):
+def shutdown_parser_pool():
+    global _parser_pool
+    if _parser_pool is not None:
+        _parser_pool.shutdown(cancel_futures=True)
+        _parser_pool = None
+
+
+def parse_stock_page(page_content: bytes) -> dict:
+    """Parses the ticker page, building the tree only once with lxml
+
+    :param page_content: content of the ticker page
+    :type page_content: bytes
+    :return: dict with the information found on the page, numeric values converted to float
+    :rtype: dict
+    """
+    result = {}
+    dom = etree.HTML(page_content, _HTML_PARSER)
+    if dom is None:
+        return result
+
+    tag = ''
+    for element in _COMPANY_INFO_XPATH(dom):
+        for child in _COMPANY_INFO_CHILDREN_XPATH(element):
+            if child.text and not child.get('class') == _LEGEND_CLASS:
+                if child.tag in {'h3', 'span'}:
+                    tag = child.text
+                else:
+                    result[tag] = child.text
+                    if child.text in {'--%', '-', '--'}:
+                        result[tag] = '0%'
+
+                    if _NUMBER_REGEX.match(result[tag]):
+                        result[tag] = float(result[tag].replace('.', '').replace('%', '').replace(',', '.'))
+
+    for element in _SECTOR_INFO_XPATH(dom):
+        for child in _SECTOR_INFO_CHILDREN_XPATH(element):
+            if child.text and not child.get('class') == _LEGEND_CLASS:
+                if child.tag in {'h3', 'span'}:
+                    tag = child.text
+                else:
+                    result[tag] = child.text
+    return result
+
+
+async def format_stock_page(page_content: bytes, logger = logging.Logger(__name__)) -> Union[None, dict]:
+    """Parses the ticker page on the process pool, so the event loop keeps running the requests
+
+    :param page_content: content of the ticker page
+    :type page_content: bytes
+    :return: dict with the information found on the page, None if the parse fails
+    :rtype: Union[None, dict]
+    """
+    global _parser_pool
+    loop = asyncio.get_running_loop()
+    pool = get_parser_pool()
     try:
-        regex = re.compile(r"^[-\d\,%\.]*$")
-        page = BeautifulSoup(page_content, "html.parser")
-        dom = lxml.etree.HTML(str(page))
-        elements = dom.xpath('//div[@id="company-section"]//div[@class="info"]')
-        result = {}
-        tag = ''
-        for element in elements:
-            children = element.xpath('./div//div//strong|./div//div//h3|./div//div//span[@class="d-inline-block mr-2"]')
-            for child in children:
-                if child.text and not child.attrib['class'] == 'title m-0 legend-tooltip':
-                    if child.tag in {'h3', 'span'}:
-                        tag = child.text
-                    else:
-                        result[tag] = child.text
-                        if child.text in {'--%', '-', '--'}:
-                            result[tag] = '0%'
-
-                        if regex.match(result[tag]):
-                            result[tag] = float(result[tag].replace('.', '').replace('%', '').replace(',', '.'))
-
-        elements_sector = dom.xpath('//div[@id="company-section"]//div[@class="top-info top-info-1 top-info-sm-2 top-info-md-n sm d-flex justify-between"]//div[contains(@class, "info")]')
-        for element in elements_sector:
-            children = element.xpath('./div//div//strong|./div//div//span')
-            for child in children:
-                if child.text and not child.attrib['class'] == 'title m-0 legend-tooltip':
-                    if child.tag in {'h3', 'span'}:
-                        tag = child.text
-                    else:
-                        result[tag] = child.text
+        return await loop.run_in_executor(pool, parse_stock_page, page_content)
+    except BrokenProcessPool:
+        # a worker died, the pool does not recover, so a new one is created on the next page
+        logger.error(f'parser pool broken, recreating it {traceback.format_exc()}')
+        if _parser_pool is pool:
+            _parser_pool = None
+            pool.shutdown(wait=False, cancel_futures=True)
     except:
-        logger.error(f'error processing {traceback.print_exc()}')
-    return result
+        logger.error(f'error processing {traceback.format_exc()}')
+    return None
 
 
 async def main():
-    resp = await get_stocks_info()
-    for ticker in resp.json():
+    stocks = await get_stocks_info()
+    for ticker in stocks:
         if ticker.get('ticker') == 'VALE3':
             pprint(ticker)
             break
     hist = await get_stocks_historical_info('VALE3')
     pprint(hist[1].json())
     page = await get_stocks_page_info('VALE3')
-    results = format_stock_page(page[1].content)
+    results = await format_stock_page(page[1].content)
     pprint(results)
 
 
@@ -0,0 +1,11 @@
+#!/bin/bash
+# starts a worker of the distributed scrape, the service container must run with SERVICE_MODE=coordinator
+WORKER_NUMBER=${1:-1}
+CONTAINER_NAME=magic_formula_worker_$WORKER_NUMBER
+IMAGE_NAME=magic_formula:latest
+
+ENTRYPOINT="/usr/bin/entrypoint_service.sh"
+
+
+docker rm -f $CONTAINER_NAME
+docker run --entrypoint $ENTRYPOINT -d --restart unless-stopped -e SERVICE_MODE=worker --link magic_formula_redis:magic_formula_redis --name $CONTAINER_NAME $IMAGE_NAME
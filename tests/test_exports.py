@@ -0,0 +1,35 @@
+import io
+
+import pandas
+import pytest
+
+import exports
+
+
+def make_ranking() -> pandas.DataFrame:
+    return pandas.DataFrame({
+        'symbol': ['AAAA3', 'BBBB4', 'CCCC3'],
+        'roic': [12.5, 30.1, -4.0],
+        'earning_yield': [0.1, 0.25, 0.05],
+        'magic_index': [3, 1, 2],
+    })
+
+
+@pytest.mark.parametrize('file_format', ['excel', 'csv', 'parquet'])
+def test_export_round_trip(file_format):
+    tickers_df = make_ranking()
+    output = exports.export_dataframe(tickers_df, file_format)
+
+    if file_format == 'excel':
+        loaded = pandas.read_excel(output)
+    elif file_format == 'csv':
+        loaded = pandas.read_csv(io.BytesIO(output.read()))
+    else:
+        loaded = pandas.read_parquet(output)
+
+    pandas.testing.assert_frame_equal(loaded, tickers_df)
+
+
+def test_export_unknown_format():
+    with pytest.raises(ValueError):
+        exports.export_dataframe(make_ranking(), 'xml')
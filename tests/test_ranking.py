@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+import ranking
+
+
+def make_columns() -> dict:
+    return {
+        'symbol': np.array(['AAAA3', 'BBBB3', 'CCCC3', 'DDDD3', 'EEEE3', 'FFFF3']),
+        'roic': np.array([10.0, 30.0, 20.0, np.nan, 30.0, 5.0]),
+        'earning_yield': np.array([0.30, 0.10, 0.20, 0.40, 0.05, np.nan]),
+    }
+
+
+def test_rank_descending_orders_by_value_with_nan_last_and_stable_ties():
+    ranks = ranking.rank_descending(np.array([1.0, np.nan, 3.0, 3.0, 2.0]))
+    assert ranks.tolist() == [3, 4, 0, 1, 2]
+
+
+def test_rank_descending_ranks_each_row():
+    ranks = ranking.rank_descending(np.array([[1.0, 2.0, 3.0], [3.0, np.nan, 1.0]]))
+    assert ranks.tolist() == [[2, 1, 0], [0, 2, 1]]
+
+
+def test_rank_stocks_uses_the_roic_values():
+    ranked = ranking.rank_stocks(make_columns())
+
+    roic_index = dict(zip(ranked['symbol'], ranked['roic_index_number']))
+    assert roic_index == {'BBBB3': 0, 'EEEE3': 1, 'CCCC3': 2, 'AAAA3': 3, 'FFFF3': 4, 'DDDD3': 5}
+
+
+def test_rank_stocks_order_and_tie_break():
+    ranked = ranking.rank_stocks(make_columns())
+
+    # roic rank + earning yield rank: AAAA3 3+1, BBBB3 0+3, CCCC3 2+2, DDDD3 5+0, EEEE3 1+4, FFFF3 4+5
+    assert ranked['symbol'].tolist() == ['BBBB3', 'AAAA3', 'CCCC3', 'DDDD3', 'EEEE3', 'FFFF3']
+    assert ranked['magic_index'].tolist() == [3, 4, 4, 5, 5, 9]
+    # ties are decided by the earning yield rank
+    assert ranked['earning_yield_index'].tolist() == [3, 1, 2, 0, 4, 5]
+
+
+def test_rank_stocks_puts_nan_at_the_end_of_the_ranks():
+    ranked = ranking.rank_stocks(make_columns())
+
+    by_symbol = {symbol: position for position, symbol in enumerate(ranked['symbol'])}
+    assert ranked['roic_index_number'][by_symbol['DDDD3']] == 5
+    assert ranked['earning_yield_index'][by_symbol['FFFF3']] == 5
+    assert ranked['symbol'][-1] == 'FFFF3'
+
+
+def test_rank_stocks_roic_ignore():
+    ranked = ranking.rank_stocks(make_columns(), roic_ignore=1)
+
+    assert ranked['symbol'].tolist() == ['DDDD3', 'AAAA3', 'CCCC3', 'BBBB3', 'EEEE3', 'FFFF3']
+    assert not ranked['roic_index_number'].any()
+
+
+@pytest.mark.parametrize('number_of_stocks', [1, 2, 3, 4, 5])
+def test_rank_stocks_partial_selection_matches_full_ranking(number_of_stocks):
+    full = ranking.rank_stocks(make_columns())
+    partial = ranking.rank_stocks(make_columns(), number_of_stocks)
+
+    for name in full:
+        np.testing.assert_array_equal(partial[name], full[name][:number_of_stocks])
+
+
+def test_rank_stocks_partial_selection_with_many_ties():
+    rng = np.random.default_rng(7)
+    columns = {
+        'symbol': np.array([f'T{i:03d}3' for i in range(200)]),
+        'roic': rng.integers(0, 5, 200).astype(float),
+        'earning_yield': rng.integers(0, 5, 200).astype(float),
+    }
+    full = ranking.rank_stocks(columns)
+    partial = ranking.rank_stocks(columns, 25)
+
+    np.testing.assert_array_equal(partial['symbol'], full['symbol'][:25])
+    assert len(set(full['earning_yield_index'].tolist())) == 200